@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import json
+import random
+import statistics
+import sys
+
+from migen import *
+
+from calculator import *
+from memory_storage import Mem
+
+# Cycle counts of the calculator and memory modules under run_simulation, one row per case
+
+def tick():
+    yield
+
+def distribution(latencies):
+    latencies = sorted(latencies)
+    return {
+        "latency_min": latencies[0],
+        "latency_median": statistics.median(latencies),
+        "latency_p90": latencies[min(len(latencies) - 1, int(0.9*len(latencies)))],
+        "latency_max": latencies[-1],
+    }
+
+def timed_calculation(dut, start_address, element_count, divide_by):
+    # calculated of the previous job clears one cycle after calculate_now_active is released
+    while (yield dut.calculated):
+        yield from tick()
+    yield dut.start_address.eq(start_address)
+    yield dut.element_count.eq(element_count)
+    yield dut.result_address.eq(0)
+    yield dut.divide_by.eq(divide_by)
+    yield dut.op.eq(OP_AVERAGE)
+    yield dut.calculate_now_active.eq(1)
+    yield from tick()
+    cycles = 1
+    while not (yield dut.calculated):
+        yield from tick()
+        cycles += 1
+    yield dut.calculate_now_active.eq(0)
+    yield from tick()
+    return cycles
+
+def timed_batch(dut, jobs):
+    for start_address, element_count, divide_by in jobs:
+        yield dut.job_start_address.eq(start_address)
+        yield dut.job_element_count.eq(element_count)
+        yield dut.job_result_address.eq(0)
+        yield dut.job_divide_by.eq(divide_by)
+        yield dut.job_op.eq(OP_AVERAGE)
+        yield dut.job_push.eq(1)
+        yield from tick()
+    yield dut.job_push.eq(0)
+    yield dut.run_batch.eq(1)
+    yield from tick()
+    cycles = 1
+    while not (yield dut.batch_done):
+        yield from tick()
+        cycles += 1
+    yield dut.run_batch.eq(0)
+    yield from tick()
+    return cycles
+
+def calculator_case(width, depth, size, divide_by, lanes, divider, jobs):
+    # the numbers are the initial content of the storage, the load is not part of what is measured
+    numbers = [random.randrange(2**width) for location in range(depth)]
+    dut = Calculator(width, depth, divider=divider, lanes=lanes, job_queue_depth=max(jobs, 2), init=numbers)
+    windows = [random.randrange(depth - size + 1) for job in range(jobs)]
+    latencies = []
+    batch = []
+
+    def story():
+        yield from tick()
+        for start_address in windows:
+            latencies.append((yield from timed_calculation(dut, start_address, size, divide_by)))
+        batch.append((yield from timed_batch(dut, [(start_address, size, divide_by) for start_address in windows])))
+
+    run_simulation(dut, story())
+    return {
+        "module": "calculator",
+        "width": width,
+        "depth": depth,
+        "size": size,
+        "divide_by": divide_by,
+        "lanes": lanes,
+        "divider": divider,
+        "jobs": jobs,
+        "cycles_per_element": statistics.mean(latencies)/size,
+        "cycles_per_job": statistics.mean(latencies),
+        "batch_cycles_per_job": batch[0]/jobs,
+        **distribution(latencies),
+    }
+
+def mem_case(depth, transactions):
+    dut = Mem(16, depth)
+    latencies = {"store": [], "recall": []}
+
+    def handshake(active, done, kind):
+        yield active.eq(1)
+        yield from tick()
+        cycles = 1
+        while not (yield done):
+            yield from tick()
+            cycles += 1
+        # the release cycle is part of the transaction, done has to fall before the next one
+        yield active.eq(0)
+        yield from tick()
+        cycles += 1
+        latencies[kind].append(cycles)
+
+    def story():
+        for i in range(transactions):
+            yield dut.where_to_store_or_recall.eq(i % depth)
+            yield dut.number_to_store.eq(i)
+            yield from handshake(dut.store_now_active, dut.stored, "store")
+            yield from handshake(dut.recall_now_active, dut.recalled, "recall")
+
+    run_simulation(dut, story())
+    return [{
+        "module": "mem",
+        "width": 16,
+        "depth": depth,
+        "size": 1,
+        "jobs": transactions,
+        "operation": kind,
+        "cycles_per_element": statistics.mean(cycles),
+        "cycles_per_job": statistics.mean(cycles),
+        **distribution(cycles),
+    } for kind, cycles in latencies.items()]
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+def main():
+    parser = argparse.ArgumentParser(description="Cycle counts of Calculator and Mem under simulation")
+    parser.add_argument("--widths",   type=int_list, default=[16, 32],             help="Data widths, comma separated")
+    parser.add_argument("--sizes",    type=int_list, default=[4, 16, 64],          help="Averaged window sizes, comma separated")
+    parser.add_argument("--divisors", type=int_list, default=[3, 10],              help="divide_by values, comma separated")
+    parser.add_argument("--lanes",    type=int_list, default=[1, 4],               help="Lane counts, comma separated")
+    parser.add_argument("--dividers", default="restoring,reciprocal",              help="Divider backends, comma separated")
+    parser.add_argument("--depth",    type=int, default=128,                       help="Calculator storage depth")
+    parser.add_argument("--jobs",     type=int, default=8,                         help="Jobs per case")
+    parser.add_argument("--seed",     type=int, default=0,                         help="Random seed")
+    parser.add_argument("--format",   choices=["csv", "json"], default="csv",      help="Output format")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    rows = []
+    for width in args.widths:
+        for size in args.sizes:
+            for divide_by in args.divisors:
+                for lanes in args.lanes:
+                    for divider in args.dividers.split(","):
+                        rows.append(calculator_case(width, args.depth, size, divide_by, lanes, divider, args.jobs))
+    rows += mem_case(16, args.jobs)
+
+    if args.format == "json":
+        json.dump(rows, sys.stdout, indent=2)
+        print()
+    else:
+        fields = []
+        for row in rows:
+            fields += [field for field in row if field not in fields]
+        writer = csv.DictWriter(sys.stdout, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+if __name__ == "__main__":
+    main()
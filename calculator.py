@@ -0,0 +1,606 @@
+#!/usr/bin/env python3
+from migen import *
+from migen.genlib.divider import Divider
+from migen.genlib.fifo import SyncFIFO
+from migen.genlib.fsm import FSM
+
+from reciprocal_divider import ReciprocalDivider
+
+# Operations selected by op, every aggregate is computed in the same pass and op picks the
+# one that is stored at result_address
+OP_AVERAGE = 0
+OP_SUM = 1
+OP_MIN = 2
+OP_MAX = 3
+OP_COUNT = 4
+OP_SUM_OF_SQUARES = 5
+ALL_OPS = (OP_AVERAGE, OP_SUM, OP_MIN, OP_MAX, OP_COUNT, OP_SUM_OF_SQUARES)
+OP_NAMES = {
+    "average": OP_AVERAGE,
+    "sum": OP_SUM,
+    "min": OP_MIN,
+    "max": OP_MAX,
+    "count": OP_COUNT,
+    "sum_of_squares": OP_SUM_OF_SQUARES,
+}
+
+# "average,min,max" to the ops to build
+def parse_ops(names):
+    ops = []
+    for name in names.split(","):
+        if name.strip() not in OP_NAMES:
+            raise ValueError(f"Unknown op {name}, expected one of {', '.join(OP_NAMES)}")
+        ops.append(OP_NAMES[name.strip()])
+    return tuple(ops)
+
+# Balanced tree of combine, log2(len(terms)) levels deep
+def reduction_tree(terms, combine):
+    while len(terms) > 1:
+        terms = [combine(terms[i], terms[i+1]) if i+1 < len(terms) else terms[i] for i in range(0, len(terms), 2)]
+    return terms[0]
+
+def adder_tree(terms):
+    return reduction_tree(terms, lambda a, b: a + b)
+
+class Calculator(Module):
+    def __init__(self, width, depth, divider="restoring", lanes=1, job_queue_depth=16, accumulator_width=None, init=None, dual_port=False, double_buffer=False, ops=ALL_OPS):
+        # by default a window covering the whole storage cannot overflow the sum
+        if accumulator_width is None:
+            accumulator_width = width + bits_for(depth)
+        # only the aggregates of ops can be stored, a job asking for another one writes nothing back and sets unsupported_op.
+        # min, max and sum of squares are not built when left out, without OP_AVERAGE there is no divider.
+        for op in ops:
+            if op not in ALL_OPS:
+                raise ValueError(f"Unknown op {op}")
+        self.ops = ops = tuple(ops)
+        if lanes & (lanes - 1):
+            raise ValueError(f"lanes must be a power of two, got {lanes}")
+        lane_bits = log2_int(lanes)
+        rows = (depth + lanes - 1)//lanes
+        # with double_buffer every bank holds two buffers of rows, the buffer is the top row address bit.
+        # Memory needs an address bit, so a single row (depth <= lanes) is kept in a bank of two
+        row_bits = bits_for(rows - 1)
+        bank_rows = 2 << row_bits if double_buffer else max(rows, 2)
+
+        # Submodules
+        # address a is stored in bank a % lanes at row a // lanes, so summing reads a word from every bank each cycle
+        # init is the initial content of locations 0 and up, a list or a NumPy array
+        if init is not None:
+            init = [int(number) for number in init]
+            if len(init) > depth:
+                raise ValueError(f"init has {len(init)} numbers but depth is {depth}")
+        self.banks = banks = [Memory(width, bank_rows, init=None if init is None else init[lane::lanes]) for lane in range(lanes)]
+        self.specials += banks
+        # "restoring" takes about width cycles per quotient, "reciprocal" takes 2 once the divisor is known
+        if OP_AVERAGE not in ops:
+            divider = None
+        elif divider == "restoring":
+            self.submodules.divider = divider = Divider(accumulator_width)
+        elif divider == "reciprocal":
+            self.submodules.divider = divider = ReciprocalDivider(accumulator_width)
+        else:
+            raise ValueError(f"Unknown divider {divider}, expected restoring or reciprocal")
+
+        # storage Signals
+        self.stored = Signal()
+        self.recalled = Signal()
+        self.where_to_store_or_recall = Signal(max=depth)
+        self.number_to_store = Signal(width)
+        self.number_recalled = Signal(width)
+        self.store_now_active = Signal()
+        self.recall_now_active = Signal()
+
+        # with dual_port, stores and recalls have their own address and enable instead of where_to_store_or_recall.
+        # They can happen in the same cycle and while a calculation or batch runs.
+        self.dual_port = dual_port
+        self.store_address = Signal(max=depth)
+        self.recall_address = Signal(max=depth)
+
+        # with double_buffer, the calculations and result write-backs use one buffer and the host
+        # stores and recalls use the other. A swap strobe flips them once no calculation or batch runs.
+        # With dual_port as well, the host fills the next dataset while the current one is reduced.
+        self.swap = Signal()
+        self.buffer = Signal()
+
+        # calculation Signals
+        self.calculate_now_active = Signal()
+        self.summed_number = Signal(accumulator_width)
+        self.calculated = Signal()
+        self.result = Signal(width)
+        self.op = Signal(3)
+
+        # aggregates of the last calculation, summed_number is the sum
+        self.minimum = Signal(width)
+        self.maximum = Signal(width)
+        self.counted = Signal(32)
+        self.sum_of_squares = Signal(accumulator_width + width)
+        # sticky, set when the sum or the sum of squares saturated since the calculation or batch started
+        self.overflow = Signal()
+        # sticky, set when a job since the calculation or batch started asked for an op left out of ops
+        self.unsupported_op = Signal()
+
+        # averaging window Signals
+        self.start_address = Signal(max=depth)
+        self.element_count = Signal(max=depth+1)
+        self.result_address = Signal(max=depth)
+
+        # batch Signals, jobs are pushed in a queue and all of them run on a single run_batch
+        self.job_start_address = Signal(max=depth)
+        self.job_element_count = Signal(max=depth+1)
+        self.job_divide_by = Signal(width)
+        self.job_result_address = Signal(max=depth)
+        self.job_op = Signal(3)
+        self.job_push = Signal()
+        self.job_writable = Signal()
+        self.run_batch = Signal()
+        self.batch_done = Signal()
+
+        # stream Signals, with from_stream set a calculation sums stream_count words of the stream instead of the storage
+        self.from_stream = Signal()
+        self.stream_count = Signal(32)
+        self.stream_valid = Signal()
+        self.stream_ready = Signal()
+        self.stream_data = Signal(width)
+
+        # division Signals
+        self.start_division = Signal()
+        self.division_finished = Signal()
+        self.result = Signal(width)
+        self.leftover = Signal(width)
+        self.dividing = Signal()
+        self.divide_by = Signal(width)
+
+        # performance counters, free running since reset or the last clear_counters.
+        # busy_cycles counts every cycle a calculation or batch job is being worked on.
+        self.clear_counters = Signal()
+        self.busy_cycles = Signal(32)
+        self.summing_cycles = Signal(32)
+        self.division_cycles = Signal(32)
+        self.dividing_cycles = Signal(32)
+        self.storing_result_cycles = Signal(32)
+        self.elements_processed = Signal(32)
+        self.jobs_completed = Signal(32)
+
+        #internal signals
+        write_ports = [bank.get_port(write_capable = True) for bank in banks]
+        read_ports = [bank.get_port(has_re=True) for bank in banks]
+        self.specials += write_ports, read_ports
+        if dual_port:
+            recall_ports = [bank.get_port() for bank in banks]
+            self.specials += recall_ports
+
+        # streaming accumulate signals, the read ports are only used by the summing state
+        # sum_index is the address of the word in lane 0 of the row being read
+        sum_index = Signal(max=depth+lanes)
+        sum_start = Signal(max=depth)
+        sum_end = Signal(max=2*depth)
+        sum_issue = Signal()
+        sum_mask = Signal(lanes)
+        sum_valid = Signal(lanes)
+
+        # words added this cycle, a row of the storage or one word of the stream in lane 0
+        streaming = Signal()
+        lane_valid = Signal(lanes)
+        lane_words = [Signal(width) for lane in range(lanes)]
+        clear_aggregates = Signal()
+        clear_overflow = Signal()
+        # wide enough for the accumulator plus a whole row, even with an accumulator narrower than the row sum
+        next_sum = Signal(max(len(self.summed_number), width + lane_bits) + 1)
+        next_sum_of_squares = Signal(max(len(self.sum_of_squares), 2*width + lane_bits) + 1)
+        sum_carry = Signal()
+        sum_of_squares_carry = Signal()
+        aggregate = Signal(len(self.sum_of_squares))
+
+        # the result is written back by the FSM itself through the write ports
+        store_strobe = Signal()
+        result_ready = Signal()
+        storing_result = Signal()
+        writing_result = Signal()
+        supported_op = Signal()
+        write_address = Signal(max=depth)
+        write_data = Signal(width)
+        write_enable = Signal()
+        recall_lane = Signal(max=max(lanes, 2))
+        swap_pending = Signal()
+        write_buffer = Signal()
+        # the FSM only handles the host storage in single port mode
+        fsm_store = Signal()
+        fsm_recall = Signal()
+        if dual_port:
+            store_address = self.store_address
+            recall_address = self.recall_address
+        else:
+            store_address = self.where_to_store_or_recall
+            recall_address = self.where_to_store_or_recall
+            self.comb += [
+                fsm_store.eq(self.store_now_active),
+                fsm_recall.eq(self.recall_now_active),
+            ]
+
+        # the job being calculated, loaded from the window Signals or popped from the job queue
+        job = Cat(self.job_start_address, self.job_element_count, self.job_divide_by, self.job_result_address, self.job_op)
+        self.submodules.jobs = jobs = SyncFIFO(len(job), job_queue_depth)
+        queued_start_address = Signal(max=depth)
+        queued_element_count = Signal(max=depth+1)
+        queued_divide_by = Signal(width)
+        queued_result_address = Signal(max=depth)
+        queued_op = Signal(3)
+        active_divide_by = Signal(width)
+        active_result_address = Signal(max=depth)
+        active_op = Signal(3)
+        batch_active = Signal()
+        stream_remaining = Signal(32)
+
+        ###
+
+        self.comb += [
+            jobs.din.eq(job),
+            jobs.we.eq(self.job_push),
+            self.job_writable.eq(jobs.writable),
+            Cat(queued_start_address, queued_element_count, queued_divide_by, queued_result_address, queued_op).eq(jobs.dout),
+        ]
+
+        self.comb += [
+            If(writing_result,
+                write_address.eq(active_result_address),
+                write_data.eq(self.result),
+                write_enable.eq(1),
+            ).Else(
+                write_address.eq(store_address),
+                write_data.eq(self.number_to_store),
+                write_enable.eq(store_strobe),
+            ),
+        ]
+        self.sync += recall_lane.eq(recall_address & (lanes - 1))
+
+        # row of an address in its bank, results go to the buffer being calculated on and the host uses the other
+        def row(address, buffer):
+            if double_buffer:
+                return Cat((address >> lane_bits)[:row_bits], buffer)
+            return address >> lane_bits
+        self.comb += write_buffer.eq(Mux(writing_result, self.buffer, ~self.buffer))
+
+        if dual_port:
+            self.comb += self.number_recalled.eq(Array(recall_port.dat_r for recall_port in recall_ports)[recall_lane])
+            self.comb += [recall_ports[lane].adr.eq(row(recall_address, ~self.buffer)) for lane in range(lanes)]
+        else:
+            self.comb += self.number_recalled.eq(Array(write_port.dat_r for write_port in write_ports)[recall_lane])
+
+        for lane in range(lanes):
+            self.comb += [
+                write_ports[lane].adr.eq(row(write_address, write_buffer)),
+                write_ports[lane].dat_w.eq(write_data),
+                write_ports[lane].we.eq(write_enable & ((write_address & (lanes - 1)) == lane)),
+                read_ports[lane].adr.eq(row(sum_index, self.buffer)),
+                read_ports[lane].re.eq(sum_issue),
+                sum_mask[lane].eq((sum_index + lane >= sum_start) & (sum_index + lane < sum_end)),
+            ]
+            if lane == 0:
+                self.comb += lane_words[lane].eq(Mux(streaming, self.stream_data, read_ports[lane].dat_r))
+            else:
+                self.comb += lane_words[lane].eq(read_ports[lane].dat_r)
+        self.comb += If(streaming,
+            lane_valid.eq(self.stream_valid & self.stream_ready),
+        ).Else(
+            lane_valid.eq(sum_valid),
+        )
+
+        # all the aggregates are updated together, lanes outside the window count as the neutral value.
+        # any bit of the sums above the accumulators is a carry, a carry saturates the accumulator.
+        # the aggregates left out of ops stay 0
+        self.comb += [
+            next_sum.eq(self.summed_number +
+                adder_tree([Mux(lane_valid[lane], lane_words[lane], 0) for lane in range(lanes)])),
+            sum_carry.eq(next_sum[len(self.summed_number):] != 0),
+            sum_of_squares_carry.eq(next_sum_of_squares[len(self.sum_of_squares):] != 0),
+        ]
+        clear = [
+            self.summed_number.eq(0),
+            self.counted.eq(0),
+        ]
+        update = [
+            self.summed_number.eq(Mux(sum_carry, 2**len(self.summed_number) - 1, next_sum)),
+            self.counted.eq(self.counted + adder_tree([lane_valid[lane] for lane in range(lanes)])),
+        ]
+        if OP_MIN in ops:
+            clear.append(self.minimum.eq(2**width - 1))
+            update.append(self.minimum.eq(reduction_tree([self.minimum] +
+                [Mux(lane_valid[lane], lane_words[lane], 2**width - 1) for lane in range(lanes)],
+                lambda a, b: Mux(a < b, a, b))))
+        if OP_MAX in ops:
+            clear.append(self.maximum.eq(0))
+            update.append(self.maximum.eq(reduction_tree([self.maximum] +
+                [Mux(lane_valid[lane], lane_words[lane], 0) for lane in range(lanes)],
+                lambda a, b: Mux(a > b, a, b))))
+        if OP_SUM_OF_SQUARES in ops:
+            self.comb += next_sum_of_squares.eq(self.sum_of_squares +
+                adder_tree([Mux(lane_valid[lane], lane_words[lane]*lane_words[lane], 0) for lane in range(lanes)]))
+            clear.append(self.sum_of_squares.eq(0))
+            update.append(self.sum_of_squares.eq(Mux(sum_of_squares_carry, 2**len(self.sum_of_squares) - 1, next_sum_of_squares)))
+        self.sync += [
+            If(clear_overflow,
+                self.unsupported_op.eq(0),
+            ).Elif(result_ready & ~supported_op,
+                self.unsupported_op.eq(1),
+            ),
+            If(clear_overflow,
+                self.overflow.eq(0),
+            ).Elif((lane_valid != 0) & (sum_carry | sum_of_squares_carry),
+                self.overflow.eq(1),
+            ),
+            If(clear_aggregates,
+                *clear
+            ).Elif(lane_valid != 0,
+                *update
+            )
+        ]
+
+        aggregates = {
+            OP_SUM: aggregate.eq(self.summed_number),
+            OP_MIN: aggregate.eq(self.minimum),
+            OP_MAX: aggregate.eq(self.maximum),
+            OP_COUNT: aggregate.eq(self.counted),
+            OP_SUM_OF_SQUARES: aggregate.eq(self.sum_of_squares),
+        }
+        self.comb += [
+            Case(active_op, {
+                **{op: statement for op, statement in aggregates.items() if op in ops},
+                "default": aggregate.eq(0),
+            }),
+            Case(active_op, {
+                **{op: supported_op.eq(1) for op in ops},
+                "default": supported_op.eq(0),
+            }),
+        ]
+
+
+        # the store is written the cycle it is asked for, unless a result is being written back,
+        # then stored waits and the store is written again the next cycle
+        if dual_port:
+            self.comb += store_strobe.eq(self.store_now_active)
+            self.sync += [
+                self.stored.eq(self.store_now_active & ~writing_result),
+                self.recalled.eq(self.recall_now_active),
+            ]
+        else:
+            self.comb += store_strobe.eq(self.store_now_active & ~self.recall_now_active)
+            self.sync += [
+                self.stored.eq(store_strobe & ~writing_result),
+            ]
+
+
+            # recalls read through the write port, a read in the cycle the result is written back
+            # gets the result, recalled waits and the location is read again the next cycle
+            self.sync += [
+                If(self.recall_now_active & ~self.store_now_active & ~writing_result,
+                    self.recalled.eq(1),
+                ).Else(
+                    self.recalled.eq(0),
+                )
+            ]
+
+#        self.sync += [
+#            If(self.summed_number == 24,[
+#                If(self.start_division & ~self.dividing, [
+#                   divider.start_i.eq(1), # start the divider module
+#                   divider.dividend_i.eq(self.summed_number),
+#                   divider.divisor_i.eq(3),
+#                   self.dividing.eq(1),
+#                ]).Else([
+#                    divider.start_i.eq(0),
+#                ]),
+#                If(self.divider.ready_o & self.dividing & ~self.start_division, [
+#                   self.result.eq(divider.quotient_o),
+#                   self.leftover.eq(divider.remainder_o),
+#                   self.division_finished.eq(1),
+#                   self.dividing.eq(0),
+#                ])
+#            ])
+#        ]
+
+
+        ###
+
+        # FSM
+        fsm = FSM(reset_state="RESET")
+        self.submodules += fsm
+
+        fsm.act("RESET",
+                NextState("INACTIVE")
+        )
+
+        fsm.act("INACTIVE",
+            NextValue(self.calculated,0),
+            If((fsm_store == 1) & (fsm_recall == 0),
+               NextState("storing"),
+            ).Elif((fsm_recall == 1) & (fsm_store == 0),
+               NextState("recalling"),
+            ).Elif((self.calculate_now_active == 1),
+                NextState("calculating"),
+            ).Elif((self.run_batch == 1),
+                clear_overflow.eq(1),
+                NextValue(batch_active,1),
+                NextState("fetching"),
+            ),
+        )
+
+        #calculation
+        fsm.act("calculating",
+            clear_aggregates.eq(1),
+            clear_overflow.eq(1),
+            NextValue(sum_index,self.start_address & ~(lanes - 1)),
+            NextValue(sum_start,self.start_address),
+            NextValue(sum_end,self.start_address + self.element_count),
+            NextValue(sum_valid,0),
+            NextValue(stream_remaining,self.stream_count),
+            NextValue(active_divide_by,self.divide_by),
+            NextValue(active_result_address,self.result_address),
+            NextValue(active_op,self.op),
+            If(self.from_stream,
+                NextState("streaming"),
+            ).Else(
+                NextState("summing"),
+            ),
+        )
+
+        #addition from the stream, one word is added per cycle while the stream is valid
+        fsm.act("streaming",
+            streaming.eq(1),
+            self.stream_ready.eq(stream_remaining != 0),
+            If(self.stream_valid & (stream_remaining != 0),
+                NextValue(stream_remaining,stream_remaining - 1),
+            ),
+            If(stream_remaining == 0,
+                NextValue(self.calculated,0),
+                NextValue(self.start_division,1),
+                NextValue(self.dividing,0),
+                NextState("division"),
+            ),
+        )
+
+        #batch, jobs are popped back to back until the queue is empty
+        fsm.act("fetching",
+            clear_aggregates.eq(1),
+            If(jobs.readable,
+                jobs.re.eq(1),
+                NextValue(sum_index,queued_start_address & ~(lanes - 1)),
+                NextValue(sum_start,queued_start_address),
+                NextValue(sum_end,queued_start_address + queued_element_count),
+                NextValue(sum_valid,0),
+                NextValue(active_divide_by,queued_divide_by),
+                NextValue(active_result_address,queued_result_address),
+                NextValue(active_op,queued_op),
+                NextState("summing"),
+            ).Else(
+                NextState("batch_done"),
+            ),
+        )
+
+        # hold batch_done until the host releases run_batch
+        fsm.act("batch_done",
+            self.batch_done.eq(1),
+            If(self.run_batch == 0,
+                NextValue(batch_active,0),
+                NextState("INACTIVE"),
+            ),
+        )
+
+        #addition, one row is issued and one word per lane is added per cycle.
+        #the row read in a cycle comes out of the read ports on the next one,
+        #so sum_valid holds the lanes of that row which are inside the window.
+        fsm.act("summing",
+            If(sum_index < sum_end,
+                sum_issue.eq(1),
+                NextValue(sum_index,sum_index + lanes),
+            ),
+            NextValue(sum_valid,sum_mask),
+            If((sum_index >= sum_end) & (sum_valid == 0),
+                NextValue(self.calculated,0),
+                NextValue(self.start_division,1),
+                NextValue(self.dividing,0),
+                NextState("division"),
+            ),
+        )
+
+
+        # only the average goes through the divider, the other aggregates are already complete
+        if divider is not None:
+            fsm.act("division",
+                If(active_op == OP_AVERAGE,
+                    NextValue(divider.start_i,1),
+                    NextValue(divider.dividend_i,self.summed_number),
+                    NextValue(divider.divisor_i,active_divide_by),
+                    NextValue(self.dividing,1),
+                    NextValue(self.start_division,0),
+                    NextState("dividing"),
+                ).Else(
+                    NextValue(self.result,aggregate),
+                    NextValue(self.start_division,0),
+                    NextState("output_is_ready"),
+                ),
+            )
+
+            fsm.act("dividing",
+                    NextValue(divider.start_i,0),
+                    If(self.divider.ready_o & ~divider.start_i,
+                       NextState("output_is_ready"),
+                       NextValue(self.result,divider.quotient_o),
+                   )
+            )
+        else:
+            fsm.act("division",
+                NextValue(self.result,aggregate),
+                NextValue(self.start_division,0),
+                NextState("output_is_ready"),
+            )
+
+        # unsupported_op is set with calculated, before the host can see the calculation done
+        fsm.act("output_is_ready",
+            result_ready.eq(1),
+            NextValue(self.dividing,0),
+            NextValue(self.calculated,~batch_active),
+            NextState("storing_result"),
+        )
+
+        # the result of an op left out of ops is not written back
+        fsm.act("storing_result",
+            storing_result.eq(1),
+            writing_result.eq(supported_op),
+            If(batch_active,
+                NextState("fetching"),
+            ).Else(
+                NextState("calculation_done"),
+            ),
+        )
+
+        # hold calculated until the host releases calculate_now_active, so the same job is not started twice
+        fsm.act("calculation_done",
+            If(self.calculate_now_active == 0,
+                NextState("INACTIVE"),
+            ),
+        )
+
+        #storing
+        fsm.act("storing",
+            If((self.stored == 1) | (self.store_now_active == 0) & (self.recall_now_active == 0),
+                NextState("INACTIVE"),
+            ),
+        )
+
+        #recalling
+        fsm.act("recalling" ,
+            If(self.recalled == 1 | (self.store_now_active == 0) & (self.recall_now_active == 0),
+                NextState("INACTIVE"),
+            ),
+        )
+
+        # performance counters, streaming is counted as summing
+        busy_states = ["calculating", "streaming", "fetching", "summing", "division", "dividing", "output_is_ready", "storing_result"]
+        counted_states = [
+            (self.busy_cycles, reduce(or_, [fsm.ongoing(state) for state in busy_states])),
+            (self.summing_cycles, fsm.ongoing("summing") | fsm.ongoing("streaming")),
+            (self.division_cycles, fsm.ongoing("division")),
+            (self.dividing_cycles, fsm.ongoing("dividing")),
+            (self.storing_result_cycles, fsm.ongoing("storing_result")),
+            (self.jobs_completed, storing_result),
+        ]
+        self.sync += [
+            If(self.clear_counters,
+                [counter.eq(0) for counter, active in counted_states],
+                self.elements_processed.eq(0),
+            ).Else(
+                [If(active, counter.eq(counter + 1)) for counter, active in counted_states],
+                self.elements_processed.eq(self.elements_processed + adder_tree([lane_valid[lane] for lane in range(lanes)])),
+            )
+        ]
+
+        # buffer swap, held back while a calculation or batch runs
+        if double_buffer:
+            self.sync += [
+                If(fsm.ongoing("INACTIVE") & (self.swap | swap_pending),
+                    self.buffer.eq(~self.buffer),
+                    swap_pending.eq(0),
+                ).Elif(self.swap,
+                    swap_pending.eq(1),
+                )
+            ]
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+import argparse
+
+from migen import *
+from migen.genlib.fsm import FSM
+
+from litex.soc.interconnect.csr import *
+from litex.soc.interconnect.csr_eventmanager import *
+from litex.soc.interconnect import wishbone
+from litex.soc.interconnect import stream
+from litex.soc.integration.soc import SoCRegion
+
+from litedram.common import LiteDRAMNativePort
+from litedram.frontend.dma import LiteDRAMDMAReader
+
+from calculator import Calculator
+
+# Calculator on the SoC bus: the window and job registers are CSRs and the storage is a
+# Wishbone memory window, one 32-bit word per calculator word. With a LiteDRAM port, a DMA
+# reader streams a table column from SDRAM straight into the accumulator.
+class CalculatorCSR(Module, AutoCSR):
+    def __init__(self, width=32, depth=1024, dram_port=None, **kwargs):
+        self.submodules.calculator = calculator = Calculator(width, depth, **kwargs)
+        self.bus = wishbone.Interface()
+
+        # the window registers also fill in the job pushed by a write to job_push
+        self._start_address = CSRStorage(name="start_address", size=len(calculator.start_address), description="First location to average.")
+        self._element_count = CSRStorage(name="element_count", size=len(calculator.element_count), description="Number of locations to average.")
+        self._divide_by = CSRStorage(name="divide_by", size=width, description="Divisor applied to the sum.")
+        self._result_address = CSRStorage(name="result_address", size=len(calculator.result_address), description="Location the result is written to.")
+        self._op = CSRStorage(name="op", size=3, description="Aggregate stored at result_address, OP_AVERAGE to OP_SUM_OF_SQUARES.")
+        self._stream_count = CSRStorage(name="stream_count", size=32, description="Number of words summed from the DMA.")
+        self._job_push = CSR(name="job_push")
+        self._swap = CSR(name="swap")
+        self._control = CSRStorage(name="control", fields=[
+            CSRField("calculate", size=1, description="Start a calculation on the window registers, hold until calculated."),
+            CSRField("run_batch", size=1, description="Run the queued jobs, hold until batch_done."),
+            CSRField("from_stream", size=1, description="Sum stream_count words from the DMA instead of the storage."),
+        ])
+        self._status = CSRStatus(name="status", fields=[
+            CSRField("calculated", size=1, description="The calculation is done."),
+            CSRField("batch_done", size=1, description="Every queued job is done."),
+            CSRField("job_writable", size=1, description="The job queue has room for another job."),
+            CSRField("overflow", size=1, description="The sum or sum of squares saturated since the calculation or batch started."),
+            CSRField("buffer", size=1, description="Buffer being calculated on, the memory window shows the other one."),
+            CSRField("unsupported_op", size=1, description="A job since the calculation or batch started asked for an op the calculator was built without, its result was not written."),
+        ])
+        self._result = CSRStatus(name="result", size=width, description="Result of the last calculation.")
+        self._sum = CSRStatus(name="sum", size=len(calculator.summed_number), description="Sum of the last calculation.")
+        self._minimum = CSRStatus(name="minimum", size=width, description="Minimum of the last calculation.")
+        self._maximum = CSRStatus(name="maximum", size=width, description="Maximum of the last calculation.")
+        self._count = CSRStatus(name="count", size=len(calculator.counted), description="Number of words in the last calculation.")
+        self._sum_of_squares = CSRStatus(name="sum_of_squares", size=len(calculator.sum_of_squares), description="Sum of squares of the last calculation.")
+
+        # performance counters, a write to counters_clear zeroes all of them
+        self._counters_clear = CSR(name="counters_clear")
+        self._busy_cycles = CSRStatus(name="busy_cycles", size=32, description="Cycles spent working on a calculation or batch job.")
+        self._summing_cycles = CSRStatus(name="summing_cycles", size=32, description="Cycles spent summing the storage or the DMA stream.")
+        self._division_cycles = CSRStatus(name="division_cycles", size=32, description="Cycles spent starting a division.")
+        self._dividing_cycles = CSRStatus(name="dividing_cycles", size=32, description="Cycles spent waiting for the divider.")
+        self._storing_result_cycles = CSRStatus(name="storing_result_cycles", size=32, description="Cycles spent writing results back.")
+        self._elements_processed = CSRStatus(name="elements_processed", size=32, description="Words summed by every calculation.")
+        self._jobs_completed = CSRStatus(name="jobs_completed", size=32, description="Calculations and batch jobs completed.")
+
+        self.submodules.ev = EventManager()
+        self.ev.batch_done = EventSourcePulse(description="Every queued job is done.")
+        self.ev.finalize()
+
+        ###
+
+        self.comb += [
+            calculator.start_address.eq(self._start_address.storage),
+            calculator.element_count.eq(self._element_count.storage),
+            calculator.divide_by.eq(self._divide_by.storage),
+            calculator.result_address.eq(self._result_address.storage),
+            calculator.op.eq(self._op.storage),
+            calculator.job_start_address.eq(self._start_address.storage),
+            calculator.job_element_count.eq(self._element_count.storage),
+            calculator.job_divide_by.eq(self._divide_by.storage),
+            calculator.job_result_address.eq(self._result_address.storage),
+            calculator.job_op.eq(self._op.storage),
+            calculator.job_push.eq(self._job_push.re),
+            calculator.swap.eq(self._swap.re),
+            calculator.calculate_now_active.eq(self._control.fields.calculate),
+            calculator.run_batch.eq(self._control.fields.run_batch),
+            calculator.from_stream.eq(self._control.fields.from_stream),
+            calculator.stream_count.eq(self._stream_count.storage),
+            self._status.fields.calculated.eq(calculator.calculated),
+            self._status.fields.batch_done.eq(calculator.batch_done),
+            self._status.fields.job_writable.eq(calculator.job_writable),
+            self._status.fields.overflow.eq(calculator.overflow),
+            self._status.fields.buffer.eq(calculator.buffer),
+            self._status.fields.unsupported_op.eq(calculator.unsupported_op),
+            self._result.status.eq(calculator.result),
+            self._sum.status.eq(calculator.summed_number),
+            self._minimum.status.eq(calculator.minimum),
+            self._maximum.status.eq(calculator.maximum),
+            self._count.status.eq(calculator.counted),
+            self._sum_of_squares.status.eq(calculator.sum_of_squares),
+            calculator.clear_counters.eq(self._counters_clear.re),
+            self._busy_cycles.status.eq(calculator.busy_cycles),
+            self._summing_cycles.status.eq(calculator.summing_cycles),
+            self._division_cycles.status.eq(calculator.division_cycles),
+            self._dividing_cycles.status.eq(calculator.dividing_cycles),
+            self._storing_result_cycles.status.eq(calculator.storing_result_cycles),
+            self._elements_processed.status.eq(calculator.elements_processed),
+            self._jobs_completed.status.eq(calculator.jobs_completed),
+        ]
+
+        # DMA, the reader CSRs set the SDRAM byte address and length of the column. The length is
+        # whole SDRAM words, the first stream_count words of it are summed, lowest word first, and
+        # clearing the reader's enable drops what is left of the column.
+        if dram_port is not None:
+            self.submodules.dma = dma = LiteDRAMDMAReader(dram_port, with_csr=True)
+            self.submodules.converter = converter = ResetInserter()(stream.Converter(dram_port.data_width, width))
+            self.comb += [
+                converter.reset.eq(~dma._enable.storage),
+                dma.source.connect(converter.sink),
+                calculator.stream_valid.eq(converter.source.valid),
+                calculator.stream_data.eq(converter.source.data),
+                converter.source.ready.eq(calculator.stream_ready),
+            ]
+
+        # one interrupt per batch, on the rising edge of batch_done
+        batch_done = Signal()
+        self.sync += batch_done.eq(calculator.batch_done)
+        self.comb += self.ev.batch_done.trigger.eq(calculator.batch_done & ~batch_done)
+
+        # memory window, every bus access goes through the calculator store/recall handshake.
+        # with dual_port=True the host can fill the window while a calculation runs.
+        # the address and data are latched, the store is still active the cycle after stored.
+        address = Signal(len(self.bus.adr))
+        data = Signal(width)
+        self.comb += [
+            calculator.where_to_store_or_recall.eq(address),
+            calculator.store_address.eq(address),
+            calculator.recall_address.eq(address),
+            calculator.number_to_store.eq(data),
+            self.bus.dat_r.eq(calculator.number_recalled),
+        ]
+
+        fsm = FSM(reset_state="IDLE")
+        self.submodules.fsm = fsm
+
+        fsm.act("IDLE",
+            NextValue(address,self.bus.adr),
+            NextValue(data,self.bus.dat_w),
+            If(self.bus.cyc & self.bus.stb,
+                If(self.bus.we,
+                    NextState("storing"),
+                ).Else(
+                    NextState("recalling"),
+                ),
+            ),
+        )
+
+        fsm.act("storing",
+            calculator.store_now_active.eq(1),
+            If(calculator.stored,
+                self.bus.ack.eq(1),
+                NextState("release"),
+            ),
+        )
+
+        fsm.act("recalling",
+            calculator.recall_now_active.eq(1),
+            If(calculator.recalled,
+                self.bus.ack.eq(1),
+                NextState("release"),
+            ),
+        )
+
+        # let stored/recalled fall back to 0 before the next access
+        fsm.act("release",
+            NextState("IDLE"),
+        )
+
+# Adds the calculator to a LiteX SoC, its registers show up in csr.json/csr.csv under name.
+# The memory window goes in the uncached IO region, above the CPU's own peripherals.
+# The DMA gets its own port on the SDRAM crossbar when the SoC has SDRAM.
+def add_calculator(soc, name="calculator", width=32, depth=1024, origin=0x90000000, with_dma=True, **kwargs):
+    dram_port = None
+    if with_dma and hasattr(soc, "sdram"):
+        dram_port = soc.sdram.crossbar.get_port()
+    calculator = CalculatorCSR(width, depth, dram_port=dram_port, **kwargs)
+    setattr(soc.submodules, name, calculator)
+    soc.add_csr(name)
+    size = 2**log2_int(4*depth, need_pow2=False)
+    soc.bus.add_slave(name + "_mem", calculator.bus, SoCRegion(origin=origin, size=size, cached=False))
+    if hasattr(soc, "irq") and soc.irq.enabled:
+        soc.irq.add(name, use_loc_if_exists=True)
+    return calculator
+
+def tick():
+    yield
+
+def simulation_story(dut):
+    # Store a few numbers through the memory window
+    for location, number in enumerate([0, 5, 7, 12]):
+        yield from dut.bus.write(location, number)
+    for location, number in enumerate([0, 5, 7, 12]):
+        recalled = yield from dut.bus.read(location)
+        if recalled != number:
+            raise Exception(f"stored number in location {location} does not match, got {recalled}")
+
+    # Average locations 0 to 3 by 3 into location 4, as the host would through the CSRs.
+    # There is no CSR bank here, so the fields are driven directly.
+    yield dut._start_address.storage.eq(0)
+    yield dut._element_count.storage.eq(4)
+    yield dut._divide_by.storage.eq(3)
+    yield dut._result_address.storage.eq(4)
+    yield dut._control.fields.calculate.eq(1)
+    for i in range(100):
+        if (yield dut._status.fields.calculated):
+            break
+        yield from tick()
+    yield dut._control.fields.calculate.eq(0)
+    yield from tick()
+
+    r = yield from dut.bus.read(4)
+    if r != 8:
+        raise Exception(f"average is not calculated correctly. Got {r} but was expecting 8")
+
+    counters = ((yield dut._jobs_completed.status), (yield dut._elements_processed.status))
+    if counters != (1, 4):
+        raise Exception(f"performance counters are not correct. Got {counters} but was expecting (1, 4)")
+    print("Simulation finished")
+
+# SDRAM behind a native read port, one word per command, held until it is taken
+class NativePortModel(Module):
+    def __init__(self, port, words):
+        memory = Memory(port.data_width, len(words), init=words)
+        read_port = memory.get_port(has_re=True)
+        self.specials += memory, read_port
+        self.comb += [
+            port.cmd.ready.eq(~port.rdata.valid | port.rdata.ready),
+            read_port.adr.eq(port.cmd.addr),
+            read_port.re.eq(port.cmd.valid & port.cmd.ready),
+            port.rdata.data.eq(read_port.dat_r),
+        ]
+        self.sync += If(port.cmd.ready, port.rdata.valid.eq(port.cmd.valid))
+
+class DMATestbench(Module):
+    def __init__(self, numbers, width=32, dram_data_width=128):
+        ratio = dram_data_width//width
+        words = [sum(number << (width*i) for i, number in enumerate(numbers[first:first + ratio]))
+                 for first in range(0, len(numbers), ratio)]
+        port = LiteDRAMNativePort("read", address_width=32, data_width=dram_data_width)
+        self.submodules.dram = NativePortModel(port, words)
+        self.submodules.calculator = CalculatorCSR(width, 16, dram_port=port)
+
+def dma_story(dut, numbers, dram_data_width=128):
+    dut = dut.calculator
+    word_bytes = dram_data_width//8
+    # (first number, numbers summed), the second one leaves part of an SDRAM word unread
+    for first, count in [(4, 8), (0, 6), (8, 4)]:
+        length = -(-4*count//word_bytes)*word_bytes
+        yield dut.dma._base.storage.eq(4*first)
+        yield dut.dma._length.storage.eq(length)
+        yield dut.dma._enable.storage.eq(1)
+        yield dut._stream_count.storage.eq(count)
+        yield dut._divide_by.storage.eq(count)
+        yield dut._result_address.storage.eq(0)
+        yield dut._control.fields.from_stream.eq(1)
+        yield dut._control.fields.calculate.eq(1)
+        for i in range(200):
+            if (yield dut._status.fields.calculated):
+                break
+            yield from tick()
+        else:
+            raise Exception(f"Timeout waiting for the streamed calculation of {count} numbers at {first}")
+        result = yield dut._result.status
+        yield dut._control.fields.calculate.eq(0)
+        yield dut._control.fields.from_stream.eq(0)
+        yield dut.dma._enable.storage.eq(0)
+        yield from tick()
+        # calculated of this calculation clears a few cycles after calculate is released
+        while (yield dut._status.fields.calculated):
+            yield from tick()
+
+        expected = sum(numbers[first:first + count])//count
+        if result != expected:
+            raise Exception(f"streamed average of {count} numbers at {first} is {result}, was expecting {expected}")
+    print("DMA simulation finished")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CalculatorCSR simulation")
+    parser.add_argument("--fast", action="store_true", help="No VCD files")
+    args = parser.parse_args()
+
+    def vcd_name(name):
+        return None if args.fast else name
+
+    dut = CalculatorCSR(32, 16)
+    run_simulation(dut, simulation_story(dut), vcd_name=vcd_name("calculator_csr.vcd"))
+
+    numbers = [3*i*i + 1 for i in range(12)]
+    dut = DMATestbench(numbers)
+    run_simulation(dut, dma_story(dut, numbers), vcd_name=vcd_name("calculator_csr_dma.vcd"))
@@ -0,0 +1,549 @@
+#!/usr/bin/env python3
+import asyncio
+import queue
+import threading
+from types import SimpleNamespace
+
+from migen import *
+
+from litex.soc.interconnect.csr import CSR, CSRStorage, CSRStatus
+
+from calculator import *
+
+# Host driver of CalculatorCSR. Application code loads, averages and runs batches of jobs,
+# the driver turns them into as few bus accesses as it can: the storage is written and read
+# in bursts, a register is only written when its value changed and the registers of one
+# calculation go out together, with the register that starts it last.
+# The same driver runs on the Migen simulator and on a LiteX RemoteClient (Etherbone, or a
+# UART through litex_server).
+
+# fields of the control and status registers, in the order of calculator_csr.py
+CONTROL_CALCULATE = 1 << 0
+CONTROL_RUN_BATCH = 1 << 1
+STATUS_CALCULATED = 1 << 0
+STATUS_BATCH_DONE = 1 << 1
+STATUS_OVERFLOW   = 1 << 3
+STATUS_UNSUPPORTED_OP = 1 << 5
+
+# aggregates wider than the stored words, calculate() reads them from their own register
+WIDE_RESULTS = {OP_SUM: "sum", OP_SUM_OF_SQUARES: "sum_of_squares"}
+
+# strobes, written every time
+STROBES = ["job_push", "swap", "counters_clear"]
+
+# words per Etherbone record
+MAX_BURST = 255
+
+# Registers and memory window of a calculator behind a LiteX RemoteClient, as named in csr.csv
+class RemoteBackend:
+    def __init__(self, bus, name="calculator"):
+        self.bus = bus
+        self.name = name
+        self.memory_base = getattr(bus.mems, name + "_mem").base
+
+    def register(self, name):
+        return getattr(self.bus.regs, f"{self.name}_{name}")
+
+    def write_registers(self, values, trigger=None):
+        # registers at consecutive addresses are written in one burst, the trigger after all of them
+        words = {}
+        for name, value in values.items():
+            register = self.register(name)
+            for i in range(register.length):
+                shift = (register.length - 1 - i)*register.data_width
+                words[register.addr + 4*i] = (value >> shift) & (2**register.data_width - 1)
+        for address, length in runs(words):
+            self.bus.write(address, [words[address + 4*i] for i in range(length)])
+        if trigger is not None:
+            self.write_registers(dict([trigger]))
+
+    def read_registers(self, names):
+        registers = [self.register(name) for name in names]
+        addresses = [register.addr + 4*i for register in registers for i in range(register.length)]
+        words = {}
+        for address, length in runs(addresses):
+            words.update(zip(range(address, address + 4*length, 4), self.bus.read(address, length)))
+        values = {}
+        for name, register in zip(names, registers):
+            values[name] = 0
+            for i in range(register.length):
+                values[name] = (values[name] << register.data_width) | words[register.addr + 4*i]
+        return values
+
+    def write_memory(self, location, numbers):
+        for first in range(0, len(numbers), MAX_BURST):
+            self.bus.write(self.memory_base + 4*(location + first), list(numbers[first:first + MAX_BURST]))
+
+    def read_memory(self, location, count):
+        numbers = []
+        for first in range(0, count, MAX_BURST):
+            numbers += self.bus.read(self.memory_base + 4*(location + first), min(MAX_BURST, count - first))
+        return numbers
+
+    def close(self):
+        pass
+
+# Stand-in for a RemoteClient: the registers of a simulated CalculatorCSR at the addresses
+# csr.csv would give them, in name order, and its memory window, counting the bus accesses
+class LoopbackBus:
+    def __init__(self, backend, name="calculator", memory_base=0x90000000):
+        self.backend = backend
+        self.memory_base = memory_base
+        self.accesses = 0
+        self.words = {}
+        regs = {}
+        address = 0
+        csrs = {attribute[1:]: value for attribute, value in vars(backend.dut).items()
+                if isinstance(value, (CSR, CSRStorage, CSRStatus))}
+        for register, csr in sorted(csrs.items()):
+            length = (csr.size + 31)//32
+            regs[f"{name}_{register}"] = SimpleNamespace(addr=address, length=length, data_width=32)
+            for i in range(length):
+                self.words[address + 4*i] = (register, length - 1 - i)
+            address += 4*length
+        self.regs = SimpleNamespace(**regs)
+        self.mems = SimpleNamespace(**{name + "_mem": SimpleNamespace(base=memory_base)})
+
+    def write(self, addr, datas):
+        self.accesses += 1
+        datas = datas if isinstance(datas, list) else [datas]
+        if addr >= self.memory_base:
+            self.backend.write_memory((addr - self.memory_base)//4, datas)
+            return
+        values = {}
+        for i, data in enumerate(datas):
+            register, word = self.words[addr + 4*i]
+            values[register] = values.get(register, 0) | data << (32*word)
+        self.backend.write_registers(values)
+
+    def read(self, addr, length=None):
+        self.accesses += 1
+        count = 1 if length is None else length
+        if addr >= self.memory_base:
+            datas = self.backend.read_memory((addr - self.memory_base)//4, count)
+        else:
+            words = [self.words[addr + 4*i] for i in range(count)]
+            values = self.backend.read_registers(list(dict.fromkeys(register for register, word in words)))
+            datas = [(values[register] >> (32*word)) & 0xffffffff for register, word in words]
+        return datas[0] if length is None else datas
+
+# consecutive CSR addresses as (first address, length), one bus access each
+def runs(addresses):
+    runs = []
+    for address in sorted(set(addresses)):
+        if runs and address == runs[-1][0] + 4*runs[-1][1] and runs[-1][1] < MAX_BURST:
+            runs[-1][1] += 1
+        else:
+            runs.append([address, 1])
+    return runs
+
+# CalculatorCSR under run_simulation, the simulation runs in a thread and serves one request
+# at a time. There is no CSR bank, the registers and their fields are driven directly, all in
+# the same cycle.
+def fields(csr):
+    return csr.fields.fields if hasattr(csr, "fields") else []
+
+class SimulationBackend:
+    def __init__(self, dut, vcd_name=None):
+        self.dut = dut
+        self.requests = queue.Queue()
+        self.replies = queue.Queue()
+        self.cycles = 0
+        self.thread = threading.Thread(target=run_simulation, args=(dut, self.serve()),
+                                       kwargs={"vcd_name": vcd_name}, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            function, args = request
+            try:
+                reply = yield from function(*args)
+            except Exception as e:
+                reply = e
+            self.replies.put(reply)
+
+    def call(self, function, *args):
+        self.requests.put((function, args))
+        reply = self.replies.get()
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    def tick(self):
+        yield
+        self.cycles += 1
+
+    def apply(self, values):
+        strobes = []
+        for name, value in values.items():
+            csr = getattr(self.dut, "_" + name)
+            if isinstance(csr, CSRStorage):
+                yield csr.storage.eq(value)
+                for field in fields(csr):
+                    yield getattr(csr.fields, field.name).eq(value >> field.offset)
+            elif value:
+                yield csr.re.eq(1)
+                strobes.append(csr)
+        yield from self.tick()
+        for csr in strobes:
+            yield csr.re.eq(0)
+
+    def write_registers(self, values, trigger=None):
+        def write():
+            yield from self.apply(values)
+            if trigger is not None:
+                yield from self.apply(dict([trigger]))
+        self.call(write)
+
+    def read_registers(self, names):
+        def read():
+            values = {}
+            for name in names:
+                csr = getattr(self.dut, "_" + name)
+                values[name] = yield csr.status
+                for field in fields(csr):
+                    values[name] |= (yield getattr(csr.fields, field.name)) << field.offset
+            yield from self.tick()
+            return values
+        return self.call(read)
+
+    def write_memory(self, location, numbers):
+        def write():
+            for i, number in enumerate(numbers):
+                yield from self.dut.bus.write(location + i, number)
+        self.call(write)
+
+    def read_memory(self, location, count):
+        def read():
+            numbers = []
+            for i in range(count):
+                numbers.append((yield from self.dut.bus.read(location + i)))
+            return numbers
+        return self.call(read)
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+class CalculatorDriver:
+    # depth, job_queue_depth and ops as the calculator was built. Results of average() are written to
+    # the last location unless a result_address is given.
+    def __init__(self, backend, depth=1024, job_queue_depth=16, ops=ALL_OPS, max_polls=10000):
+        self.backend = backend
+        self.depth = depth
+        self.job_queue_depth = job_queue_depth
+        self.ops = tuple(ops)
+        self.max_polls = max_polls
+        self.registers = {}
+        self.overflow = False
+        self.unsupported_op = False
+
+    def write(self, values, trigger=None):
+        changed = {name: value for name, value in values.items() if self.registers.get(name) != value}
+        if trigger is not None and trigger[0] not in STROBES and self.registers.get(trigger[0]) == trigger[1]:
+            trigger = None
+        self.backend.write_registers(changed, trigger)
+        self.registers.update(changed)
+        if trigger is not None and trigger[0] not in STROBES:
+            self.registers[trigger[0]] = trigger[1]
+
+    def wait(self, mask, extra=[]):
+        for i in range(self.max_polls):
+            values = self.backend.read_registers(["status"] + extra)
+            if values["status"] & mask:
+                self.overflow = bool(values["status"] & STATUS_OVERFLOW)
+                self.unsupported_op = bool(values["status"] & STATUS_UNSUPPORTED_OP)
+                return values
+        raise TimeoutError(f"calculator status did not reach {mask:#x} in {self.max_polls} polls")
+
+    def load(self, numbers, location=0):
+        if location + len(numbers) > self.depth:
+            raise ValueError(f"{len(numbers)} numbers at {location} do not fit in {self.depth} locations")
+        self.backend.write_memory(location, list(numbers))
+
+    def dump(self, location, count):
+        return self.backend.read_memory(location, count)
+
+    def window(self, start, count, divide_by=None, result_address=None, op=OP_AVERAGE):
+        if op not in self.ops:
+            raise ValueError(f"op {op} is not built in the calculator, it has {self.ops}")
+        if start + count > self.depth:
+            raise ValueError(f"window of {count} numbers at {start} is past {self.depth} locations")
+        if result_address is None:
+            result_address = self.depth - 1
+        if start <= result_address < start + count:
+            raise ValueError(f"window of {count} numbers at {start} holds the result location {result_address}")
+        return {
+            "start_address": start,
+            "element_count": count,
+            "divide_by": count if divide_by is None else divide_by,
+            "result_address": result_address,
+            "op": op,
+        }
+
+    def calculate(self, start, count, op=OP_AVERAGE, divide_by=None, result_address=None):
+        register = WIDE_RESULTS.get(op, "result")
+        self.write(self.window(start, count, divide_by, result_address, op), trigger=("control", CONTROL_CALCULATE))
+        result = self.wait(STATUS_CALCULATED, [register])[register]
+        self.write({"control": 0})
+        if self.unsupported_op:
+            raise ValueError(f"op {op} is not built in the calculator")
+        return result
+
+    def average(self, start, count, divide_by=None, result_address=None):
+        return self.calculate(start, count, OP_AVERAGE, divide_by, result_address)
+
+    # jobs are (start, count), (start, count, op) or (start, count, op, divide_by), their results
+    # are written one after the other from result_address and returned. interrupt, when given,
+    # blocks until the batch_done interrupt and acknowledges it, the status is then read once.
+    # The results are read back from the storage, so the sums, wider than a word, are refused.
+    def batch(self, jobs, result_address, op=OP_AVERAGE, interrupt=None):
+        if result_address + len(jobs) > self.depth:
+            raise ValueError(f"{len(jobs)} results at {result_address} do not fit in {self.depth} locations")
+        for start, count, *rest in jobs:
+            job_op = rest[0] if rest else op
+            if job_op not in self.ops:
+                raise ValueError(f"op {job_op} is not built in the calculator, it has {self.ops}")
+            if job_op in WIDE_RESULTS:
+                raise ValueError(f"op {job_op} does not fit in a stored result, use calculate()")
+            if start < result_address + len(jobs) and result_address < start + count:
+                raise ValueError(f"window of {count} numbers at {start} overlaps the results at {result_address}")
+        for first in range(0, len(jobs), self.job_queue_depth):
+            for i, job in enumerate(jobs[first:first + self.job_queue_depth]):
+                start, count = job[:2]
+                job_op = job[2] if len(job) > 2 else op
+                divide_by = job[3] if len(job) > 3 else None
+                self.write(self.window(start, count, divide_by, result_address + first + i, job_op),
+                           trigger=("job_push", 1))
+            self.write({"control": CONTROL_RUN_BATCH})
+            if interrupt is not None:
+                interrupt()
+            self.wait(STATUS_BATCH_DONE)
+            self.write({"control": 0})
+            if self.unsupported_op:
+                raise ValueError("a job of the batch asked for an op that is not built in the calculator")
+        return self.dump(result_address, len(jobs))
+
+    def counters(self):
+        return self.backend.read_registers(["busy_cycles", "summing_cycles", "division_cycles", "dividing_cycles",
+                                            "storing_result_cycles", "elements_processed", "jobs_completed"])
+
+    def clear_counters(self):
+        self.write({}, trigger=("counters_clear", 1))
+
+    def close(self):
+        self.backend.close()
+
+# asyncio client: submit() returns a future right away and a worker thread runs the submitted
+# jobs as batches of up to job_queue_depth, so a coroutine waiting for a result does not hold a
+# thread. Jobs submitted while a batch runs go in the next one. The results are written to the
+# job_queue_depth locations at result_address, the last ones of the storage by default.
+class AsyncCalculator:
+    def __init__(self, driver, result_address=None, interrupt=None):
+        self.driver = driver
+        if result_address is None:
+            result_address = driver.depth - driver.job_queue_depth
+        self.result_address = result_address
+        self.interrupt = interrupt
+        self.jobs = queue.Queue()
+        self.loop = None
+        self.thread = None
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exception):
+        await self.close()
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, start, count, op=OP_AVERAGE, divide_by=None):
+        if op in WIDE_RESULTS:
+            raise ValueError(f"op {op} does not fit in a stored result, use CalculatorDriver.calculate()")
+        self.driver.window(start, count, divide_by, op=op)
+        results_end = self.result_address + self.driver.job_queue_depth
+        if start < results_end and self.result_address < start + count:
+            raise ValueError(f"window of {count} numbers at {start} overlaps the results at "
+                             f"{self.result_address} to {results_end - 1}")
+        future = self.loop.create_future()
+        self.jobs.put(((start, count, op, divide_by), future))
+        return future
+
+    async def average(self, start, count, divide_by=None):
+        return await self.submit(start, count, OP_AVERAGE, divide_by)
+
+    async def close(self):
+        self.jobs.put(None)
+        await self.loop.run_in_executor(None, self.thread.join)
+
+    def run(self):
+        while True:
+            batch = [self.jobs.get()]
+            while batch[-1] is not None and len(batch) < self.driver.job_queue_depth:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is None
+            batch = [job for job in batch if job is not None]
+            if batch:
+                try:
+                    results = self.driver.batch([job for job, future in batch], self.result_address,
+                                                interrupt=self.interrupt)
+                    for (job, future), result in zip(batch, results):
+                        self.loop.call_soon_threadsafe(resolve, future, result)
+                except Exception as e:
+                    for job, future in batch:
+                        self.loop.call_soon_threadsafe(resolve, future, None, e)
+            if stop:
+                return
+
+def resolve(future, result, exception=None):
+    # the coroutine may have given up on it
+    if future.cancelled():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+async def async_story(driver, numbers):
+    # more jobs than the queue holds, all in flight at once
+    jobs = [(i, 8) for i in range(0, 32)]
+    async with AsyncCalculator(driver) as calculator:
+        results = await asyncio.gather(*[calculator.submit(start, count) for start, count in jobs])
+        maximum = await calculator.submit(0, 40, op=OP_MAX)
+        # the results go to the last job_queue_depth locations, a window over them is refused
+        try:
+            calculator.submit(44, 8)
+        except ValueError:
+            pass
+        else:
+            raise Exception("a window over the result locations was accepted")
+        try:
+            calculator.submit(0, 8, op=OP_SUM)
+        except ValueError:
+            pass
+        else:
+            raise Exception("a sum, wider than a stored result, was accepted")
+    expected = [sum(numbers[start:start + count])//count for start, count in jobs]
+    if results != expected:
+        raise Exception(f"asynchronous jobs are not calculated correctly. Got {results} but was expecting {expected}")
+    if maximum != max(numbers):
+        raise Exception(f"asynchronous maximum is not correct. Got {maximum} but was expecting {max(numbers)}")
+
+def driver_story(driver, numbers):
+    driver.load(numbers)
+    if driver.dump(0, len(numbers)) != numbers:
+        raise Exception("loaded numbers do not match")
+
+    result = driver.average(4, 10)
+    expected = sum(numbers[4:14])//10
+    if result != expected:
+        raise Exception(f"average is not calculated correctly. Got {result} but was expecting {expected}")
+    maximum = driver.calculate(0, 40, op=OP_MAX)
+    if maximum != max(numbers):
+        raise Exception(f"maximum is not calculated correctly. Got {maximum} but was expecting {max(numbers)}")
+
+    # the default result location is the last one, a window over it is refused
+    try:
+        driver.average(0, driver.depth)
+    except ValueError:
+        pass
+    else:
+        raise Exception("a window over the result location was accepted")
+
+    # more jobs than the queue holds, in two runs
+    jobs = [(i, 5) for i in range(20)]
+    results = driver.batch(jobs, result_address=40)
+    expected = [sum(numbers[start:start + count])//count for start, count in jobs]
+    if results != expected:
+        raise Exception(f"batch is not calculated correctly. Got {results} but was expecting {expected}")
+
+    counters = driver.counters()
+    if counters["jobs_completed"] != 22:
+        raise Exception(f"jobs_completed is {counters['jobs_completed']}, was expecting 22")
+
+    # the sums are wider than the stored words, they are read whole from their registers
+    large = [2**32 - 1, 2**32 - 1, 5]
+    driver.load(large, location=50)
+    for op, expected in [(OP_SUM, sum(large)), (OP_SUM_OF_SQUARES, sum(n*n for n in large))]:
+        result = driver.calculate(50, 3, op=op)
+        if result != expected:
+            raise Exception(f"aggregate {op} is not calculated correctly. Got {result} but was expecting {expected}")
+    try:
+        driver.batch([(50, 3, OP_SUM)], result_address=40)
+    except ValueError:
+        pass
+    else:
+        raise Exception("a sum, wider than a stored result, was accepted in a batch")
+
+def ops_story(driver, numbers):
+    # the calculator is built with the average and the maximum only
+    driver.load(numbers)
+    maximum = driver.calculate(0, 40, op=OP_MAX)
+    if maximum != max(numbers):
+        raise Exception(f"maximum is not calculated correctly. Got {maximum} but was expecting {max(numbers)}")
+    # an op left out is refused before it reaches the calculator
+    try:
+        driver.calculate(0, 40, op=OP_MIN)
+    except ValueError:
+        pass
+    else:
+        raise Exception("an op left out of the calculator was accepted")
+    # and reported by the calculator when the driver is told it is there
+    driver.ops = ALL_OPS
+    try:
+        driver.calculate(0, 40, op=OP_MIN)
+    except ValueError:
+        pass
+    else:
+        raise Exception("the calculator did not report an op it was built without")
+    result = driver.average(0, 40)
+    if (result, driver.unsupported_op) != (sum(numbers)//40, False):
+        raise Exception(f"average after an unsupported op is {result}, unsupported_op {driver.unsupported_op}")
+
+if __name__ == "__main__":
+    from calculator_csr import CalculatorCSR
+
+    numbers = [(7*i + 3) % 100 for i in range(40)]
+    dut = CalculatorCSR(32, 64, lanes=2)
+    driver = CalculatorDriver(SimulationBackend(dut), depth=64, job_queue_depth=16)
+    try:
+        driver_story(driver, numbers)
+        asyncio.run(async_story(driver, numbers))
+        print(f"{driver.backend.cycles} cycles")
+        print("Driver simulation ended successfully")
+    finally:
+        driver.close()
+
+    # the same through RemoteBackend, the 40 numbers are loaded in one bus access
+    dut = CalculatorCSR(32, 64, lanes=2)
+    bus = LoopbackBus(SimulationBackend(dut))
+    driver = CalculatorDriver(RemoteBackend(bus), depth=64, job_queue_depth=16)
+    try:
+        driver_story(driver, numbers)
+        accesses = bus.accesses
+        driver.load(numbers)
+        if bus.accesses != accesses + 1:
+            raise Exception(f"loading {len(numbers)} numbers took {bus.accesses - accesses} bus accesses")
+        print(f"{bus.accesses} bus accesses")
+        print("Remote driver simulation ended successfully")
+    finally:
+        driver.close()
+
+    ops = (OP_AVERAGE, OP_MAX)
+    dut = CalculatorCSR(32, 64, ops=ops)
+    driver = CalculatorDriver(SimulationBackend(dut), depth=64, job_queue_depth=16, ops=ops)
+    try:
+        ops_story(driver, numbers)
+        print("Driver ops simulation ended successfully")
+    finally:
+        driver.close()
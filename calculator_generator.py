@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+import argparse
+
+from migen import *
+from migen.fhdl import verilog
+
+from calculator import *
+from verilator_sim import default_ios
+
+# Elaborates a calculator for a data width, memory depth, number of lanes and set of ops, and
+# writes it out as Verilog. Every public Signal of the calculator is a port of the top module.
+
+def generate(width=32, depth=1024, lanes=1, ops=ALL_OPS, divider="restoring", **kwargs):
+    return Calculator(width, depth, divider=divider, lanes=lanes, ops=ops, **kwargs)
+
+def generator_args(parser):
+    parser.add_argument("--width",         type=int, default=32,    help="Data width")
+    parser.add_argument("--depth",         type=int, default=1024,  help="Number of stored words")
+    parser.add_argument("--lanes",         type=int, default=1,     help="Words summed per cycle, a power of two")
+    parser.add_argument("--ops",           default=",".join(OP_NAMES), help="Enabled ops, comma separated")
+    parser.add_argument("--divider",       default="restoring",     help="Divider backend, restoring or reciprocal")
+    parser.add_argument("--dual-port",     action="store_true",     help="Independent store and recall addresses")
+    parser.add_argument("--double-buffer", action="store_true",     help="Ping-pong buffers swapped by the swap strobe")
+
+def generator_kwargs(args):
+    return dict(width=args.width, depth=args.depth, lanes=args.lanes, ops=parse_ops(args.ops),
+                divider=args.divider, dual_port=args.dual_port, double_buffer=args.double_buffer)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calculator Verilog generator")
+    generator_args(parser)
+    parser.add_argument("--name",   default="calculator",   help="Top module name")
+    parser.add_argument("--output", default="calculator.v", help="Verilog file")
+    args = parser.parse_args()
+
+    dut = generate(**generator_kwargs(args))
+    verilog.convert(dut, ios=set(default_ios(dut)), name=args.name).write(args.output)
+    print(f"{args.output}: {args.width} bits, {args.depth} words, {args.lanes} lanes, ops {args.ops}")
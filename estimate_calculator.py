@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+import argparse
+import math
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+from migen import *
+from migen.fhdl import verilog
+
+from calculator import *
+from calculator_generator import generate
+from verilator_sim import default_ios
+
+# Quick BRAM/DSP/LUT and logic depth estimate of a calculator configuration, before a full
+# Vivado run. With yosys in the PATH the Verilog is synthesized with synth_xilinx and the cells
+# are counted, otherwise the numbers come from a model of the calculator's datapath.
+
+# resources of the devices we build for
+DEVICES = {
+    "xc7a35t":  {"lut": 20800,  "ff": 41600,  "bram36": 50,  "dsp": 90},
+    "xc7a100t": {"lut": 63400,  "ff": 126800, "bram36": 135, "dsp": 240},
+}
+
+# Artix-7 -1 timing: register clock to out plus setup, and one logic level with its routing.
+# Most levels are CARRY4s of the carry chains, much faster than a LUT, this is the average
+REGISTER_DELAY_NS = 1.5
+LEVEL_DELAY_NS = 0.25
+
+# BRAM36 aspect ratios, depth x width
+BRAM36_SHAPES = [(32768, 1), (16384, 2), (8192, 4), (4096, 9), (2048, 18), (1024, 36), (512, 72)]
+
+def bram36(rows, width):
+    return min(math.ceil(rows/depth)*math.ceil(width/shape_width) for depth, shape_width in BRAM36_SHAPES)
+
+# DSP48E1 is a 25x18 signed multiplier
+def dsp48(a, b):
+    return min(math.ceil(a/24)*math.ceil(b/17), math.ceil(a/17)*math.ceil(b/24))
+
+def analytic_estimate(width, depth, lanes=1, ops=ALL_OPS, divider="restoring", dual_port=False,
+                      double_buffer=False, accumulator_width=None, **kwargs):
+    if accumulator_width is None:
+        accumulator_width = width + bits_for(depth)
+    squares_width = accumulator_width + width
+    rows = (depth + lanes - 1)//lanes
+    bank_rows = 2 << bits_for(rows - 1) if double_buffer else max(rows, 2)
+    tree_levels = log2_int(lanes, need_pow2=False)
+
+    # a bank is one write and one read port, the recall port of dual_port is a copy of it
+    banks = lanes*bram36(bank_rows, width)*(2 if dual_port else 1)
+
+    dsp = 0
+    if OP_SUM_OF_SQUARES in ops:
+        dsp += lanes*dsp48(width, width)
+    if OP_AVERAGE in ops and divider == "reciprocal":
+        dsp += dsp48(accumulator_width, accumulator_width + 1) + dsp48(accumulator_width, accumulator_width)
+
+    # one LUT per bit of every adder, comparator and 2:1 mux, plus the FSM and the job queue
+    lut = (lanes - 1)*accumulator_width + accumulator_width   # sum adder tree and accumulator
+    lut += lanes*width                                         # lane masking
+    if OP_MIN in ops:
+        lut += lanes*2*width
+    if OP_MAX in ops:
+        lut += lanes*2*width
+    if OP_SUM_OF_SQUARES in ops:
+        lut += lanes*squares_width
+    if OP_AVERAGE in ops:
+        lut += 3*accumulator_width if divider == "restoring" else 4*accumulator_width
+    lut += 6*squares_width + 200
+    ff = 4*squares_width + 3*accumulator_width + 8*32 + 200
+
+    # carry chains of the sum, or the compare chain of min/max, whichever is the longest
+    levels = (tree_levels + 1)*(2 + math.ceil(accumulator_width/4))
+    if OP_MIN in ops or OP_MAX in ops:
+        levels = max(levels, (tree_levels + 1)*(2 + math.ceil(width/4) + 1))
+    if OP_SUM_OF_SQUARES in ops:
+        levels = max(levels, 2*dsp48(width, width) + (tree_levels + 1)*(2 + math.ceil(squares_width/4)))
+
+    return {"source": "model", "lut": lut, "ff": ff, "bram36": banks, "dsp": dsp, "logic_levels": levels}
+
+def yosys_estimate(dut, name="calculator"):
+    with tempfile.TemporaryDirectory() as build_dir:
+        source = os.path.join(build_dir, name + ".v")
+        verilog.convert(dut, ios=set(default_ios(dut)), name=name).write(source)
+        script = (f"read_verilog {source}; synth_xilinx -flatten -top {name}; "
+                  f"tee -q -o report.txt stat; tee -q -a report.txt ltp -noff")
+        subprocess.run(["yosys", "-q", "-p", script], cwd=build_dir, check=True)
+        output = open(os.path.join(build_dir, "report.txt")).read()
+
+    # stat lists "cell count", or "count cell" in newer yosys
+    cells = {}
+    for cell, count in re.findall(r"^\s+([A-Z]\w+)\s+(\d+)$", output, re.MULTILINE):
+        cells[cell] = cells.get(cell, 0) + int(count)
+    for count, cell in re.findall(r"^\s+(\d+)\s+([A-Z]\w+)$", output, re.MULTILINE):
+        cells[cell] = cells.get(cell, 0) + int(count)
+    path = re.search(r"length=(\d+)", output)
+    return {
+        "source": "yosys",
+        "lut": sum(count for cell, count in cells.items() if re.fullmatch(r"LUT\d", cell)),
+        "ff": sum(count for cell, count in cells.items() if re.fullmatch(r"FD\w+", cell)),
+        "bram36": cells.get("RAMB36E1", 0) + cells.get("RAMB18E1", 0)/2,
+        "dsp": cells.get("DSP48E1", 0),
+        "logic_levels": int(path.group(1)) if path else None,
+    }
+
+def estimate(use_yosys=True, **kwargs):
+    if use_yosys and shutil.which("yosys") is not None:
+        return yosys_estimate(generate(**kwargs))
+    return analytic_estimate(**kwargs)
+
+def fits(resources, device):
+    return all(resources[resource] <= budget for resource, budget in DEVICES[device].items())
+
+# delay of the longest register to register path, None when it is not known
+def delay_ns(resources):
+    if resources["logic_levels"] is None:
+        return None
+    return REGISTER_DELAY_NS + LEVEL_DELAY_NS*resources["logic_levels"]
+
+def meets_clock(resources, sys_clk_freq):
+    delay = delay_ns(resources)
+    return delay is None or delay <= 1e9/sys_clk_freq
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resource and logic depth estimate of calculator configurations")
+    parser.add_argument("--width",     type=int, default=32,          help="Data width")
+    parser.add_argument("--depth",     type=int, default=1024,        help="Number of stored words")
+    parser.add_argument("--lanes",     default="1,2,4,8",             help="Lane counts to compare, comma separated")
+    parser.add_argument("--ops",       default=",".join(OP_NAMES),    help="Enabled ops, comma separated")
+    parser.add_argument("--divider",   default="restoring",           help="Divider backend, restoring or reciprocal")
+    parser.add_argument("--dual-port", action="store_true",           help="Independent store and recall addresses")
+    parser.add_argument("--double-buffer", action="store_true",       help="Ping-pong buffers swapped by the swap strobe")
+    parser.add_argument("--device",    default="xc7a35t", choices=list(DEVICES), help="Device budget to check against")
+    parser.add_argument("--sys-clk-freq", type=float, default=50e6, help="System clock frequency the calculator has to meet")
+    parser.add_argument("--no-yosys",  action="store_true",           help="Use the model even if yosys is installed")
+    args = parser.parse_args()
+
+    budget = DEVICES[args.device]
+    print(f"{args.device}: {budget['lut']} LUT, {budget['ff']} FF, {budget['bram36']} BRAM36, {budget['dsp']} DSP, "
+          f"{1e9/args.sys_clk_freq:.1f} ns clock period")
+    # every configuration runs at sys_clk_freq, the one summing the most words per cycle wins
+    best = None
+    for lanes in [int(lanes) for lanes in args.lanes.split(",")]:
+        resources = estimate(use_yosys=not args.no_yosys, width=args.width, depth=args.depth, lanes=lanes,
+                             ops=parse_ops(args.ops), divider=args.divider, dual_port=args.dual_port,
+                             double_buffer=args.double_buffer)
+        fit = fits(resources, args.device)
+        timing = meets_clock(resources, args.sys_clk_freq)
+        if fit and timing and (best is None or lanes > best):
+            best = lanes
+        delay = delay_ns(resources)
+        print(f"lanes {lanes}: {resources['lut']} LUT, {resources['ff']} FF, {resources['bram36']} BRAM36, "
+              f"{resources['dsp']} DSP, {resources['logic_levels']} logic levels, "
+              f"{'unknown delay' if delay is None else f'{delay:.1f} ns'} ({resources['source']})"
+              f"{'' if fit else ', does not fit'}{'' if timing else ', misses the clock'}")
+    if best is None:
+        print("No configuration fits and meets the clock")
+    else:
+        print(f"Fastest configuration that fits and meets the clock: {best} lanes, {best} words per cycle")
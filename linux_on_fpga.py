@@ -9,24 +9,49 @@
 import sys
 import argparse
 import os
+import time
+import json
+import hashlib
+import inspect
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
 
-from litex.soc.cores.cpu import VexRiscvSMP
-from litex.soc.integration.builder import Builder
-
-from linux_on_litex_vexriscv.soc_linux import SoCLinux
+# LiteX, the CPU, the SoC and the calculator are only imported when a board is built, so that
+# --help, --list-boards and --prepare come up quickly.
 
 kB = 1024
 
+# Third-party sources are fetched once by --prepare, under build/deps.
+DEPS_DIR = os.path.join("build", "deps")
+
 # Board definition----------------------------------------------------------------------------------
 
 class Board:
     soc_kwargs = {"integrated_rom_size": 0x9000, "l2_size": 0}
+    # Calculator size for the boards with the "calculator" capability. This default is small (a
+    # 32 kbit storage, one lane) and is not checked against any board, boards override it once sized
+    # (estimate_calculator.py) and --calculator-* options override both.
+    calculator_kwargs = {"width": 32, "depth": 1024, "lanes": 1}
+    # Sources not installable with pip, fetched by --prepare: name: git clone arguments.
+    dependencies = {}
     def __init__(self, soc_cls=None, soc_capabilities={}, soc_constants={}, bitstream_ext=""):
         self.soc_cls          = soc_cls
         self.soc_capabilities = soc_capabilities
         self.soc_constants    = soc_constants
         self.bitstream_ext    = bitstream_ext
 
+    # Platform of a cached build, without creating the SoC: the target module imports its platform
+    # module, whose Platform takes some of the SoC arguments (device, variant, toolchain).
+    def create_platform(self, soc_kwargs):
+        target = sys.modules[self.soc_cls.__module__]
+        for value in vars(target).values():
+            if inspect.ismodule(value) and inspect.isclass(getattr(value, "Platform", None)):
+                parameters = inspect.signature(value.Platform).parameters
+                self.platform = value.Platform(**{k: v for k, v in soc_kwargs.items() if k in parameters})
+                return
+        from linux_on_litex_vexriscv.soc_linux import SoCLinux
+        self.platform = SoCLinux(self.soc_cls, **soc_kwargs).platform
+
     def load(self, filename):
         prog = self.platform.create_programmer()
         prog.load_bitstream(filename)
@@ -58,6 +83,8 @@ class Qmtech_xc7a35t_256(Board):
         "uart_baudrate" : 115200,
         "sys_clk_freq"   : int(50e6), 
     } 
+    # xc7a35t: 50 BRAM36 and 90 DSP48, most of them left to the CPU and its caches
+    calculator_kwargs = {"width": 32, "depth": 4096, "lanes": 4}
     def __init__(self):
         import qmtech_xc7a35t_256
         Board.__init__(self, qmtech_xc7a35t_256.BaseSoC, soc_capabilities={
@@ -65,6 +92,8 @@ class Qmtech_xc7a35t_256(Board):
             "serial",
             # Storage
             "spisdcard",
+            # Accelerators
+            "calculator",
         }, bitstream_ext=".bit")
 
 # Arty support -------------------------------------------------------------------------------------
@@ -372,10 +401,12 @@ class OrangeCrab(Board):
         "sys_clk_freq" : int(64e6), # Increase sys_clk_freq to 64MHz (48MHz default).
         "l2_size"      : 2048,      # Use Wishbone and L2 for memory accesses.
     }
+    dependencies = {
+        "valentyusb" : ["https://github.com/litex-hub/valentyusb", "-b", "hw_cdc_eptri"],
+    }
     def __init__(self):
         from litex_boards.targets import orangecrab
-        os.system("git clone https://github.com/litex-hub/valentyusb -b hw_cdc_eptri")
-        sys.path.append("valentyusb") # FIXME: do proper install of ValentyUSB.
+        add_dependencies(self)
         Board.__init__(self, orangecrab.BaseSoC, soc_capabilities={
             # Communication
             "usb_acm",
@@ -540,13 +571,226 @@ supported_boards = {
     "qmtech_ep4ce15":  Qmtech_EP4CE15,
 }
 
+# Dependencies --------------------------------------------------------------------------------------
+
+def prepare(board_names):
+    for board_name in board_names:
+        for name, clone_args in supported_boards[board_name].dependencies.items():
+            path = os.path.join(DEPS_DIR, name)
+            if os.path.isdir(path):
+                continue
+            print(f"{board_name}: fetching {name} into {path}")
+            subprocess.run(["git", "clone", *clone_args, path], check=True)
+
+def add_dependencies(board):
+    for name in board.dependencies:
+        path = os.path.join(DEPS_DIR, name)
+        if not os.path.isdir(path):
+            raise RuntimeError(f"{name} not found in {DEPS_DIR}, run with --prepare first")
+        sys.path.append(path) # FIXME: do proper install of ValentyUSB.
+
+# Build cache ---------------------------------------------------------------------------------------
+
+# A board is only regenerated when one of these, its SoC parameters or the command line changed.
+CACHED_SOURCES = [
+    "linux_on_fpga.py",
+    "calculator.py",
+    "calculator_csr.py",
+    "reciprocal_divider.py",
+    "qmtech_xc7a35t_256 platform.py",
+    "qmtech_xc7a35t_256 target.py",
+]
+# arguments that do not change what ends up in build/<board_name>
+# --build is tracked by the bitstream flag of the cache instead.
+UNCACHED_ARGS = ["board", "build", "jobs", "load", "flash", "no_cache", "list_boards", "prepare"]
+
+def build_key(board_name, soc_kwargs, calculator_kwargs, args):
+    key = hashlib.sha256()
+    key.update(json.dumps({
+        "board"      : board_name,
+        "soc_kwargs" : soc_kwargs,
+        "calculator" : calculator_kwargs,
+        "args"       : {k: v for k, v in vars(args).items() if k not in UNCACHED_ARGS},
+    }, sort_keys=True, default=str).encode())
+    for source in CACHED_SOURCES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), source), "rb") as f:
+            key.update(f.read())
+    return key.hexdigest()
+
+def read_cache(build_dir):
+    try:
+        with open(os.path.join(build_dir, "build_cache.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_cache(build_dir, cache):
+    with open(os.path.join(build_dir, "build_cache.json"), "w") as f:
+        json.dump(cache, f, indent=4)
+
+# Board build ---------------------------------------------------------------------------------------
+
+# SoC, gateware, DTS and DTB of one board under build/<board_name>, returns the time spent on each stage.
+def build_board(board_name, args):
+    from litex.soc.cores.cpu import VexRiscvSMP
+    from calculator import parse_ops
+
+    timings = {}
+    start = time.time()
+    board = supported_boards[board_name]()
+    soc_kwargs = dict(Board.soc_kwargs)
+    soc_kwargs.update(board.soc_kwargs)
+
+    # CPU parameters -------------------------------------------------------------------------------
+    # Do memory accesses through Wishbone and L2 cache when L2 size is configured.
+    args.with_wishbone_memory = soc_kwargs["l2_size"] != 0
+    VexRiscvSMP.args_read(args)
+
+    # SoC parameters -------------------------------------------------------------------------------
+    if args.device is not None:
+        soc_kwargs.update(device=args.device)
+    if args.variant is not None:
+        soc_kwargs.update(variant=args.variant)
+    if args.toolchain is not None:
+        soc_kwargs.update(toolchain=args.toolchain)
+    if "usb_fifo" in board.soc_capabilities:
+        soc_kwargs.update(uart_name="usb_fifo")
+    if "usb_acm" in board.soc_capabilities:
+        soc_kwargs.update(uart_name="usb_acm")
+    if "ethernet" in board.soc_capabilities:
+        soc_kwargs.update(with_ethernet=True)
+    if "sata" in board.soc_capabilities:
+        soc_kwargs.update(with_sata=True)
+    if "video_terminal" in board.soc_capabilities:
+        soc_kwargs.update(with_video_terminal=True)
+    if "framebuffer" in board.soc_capabilities:
+        soc_kwargs.update(with_video_framebuffer=True)
+
+    calculator_kwargs = dict(board.calculator_kwargs)
+    for name in ["width", "depth", "lanes"]:
+        if getattr(args, "calculator_" + name) is not None:
+            calculator_kwargs[name] = getattr(args, "calculator_" + name)
+    if args.calculator_ops is not None:
+        calculator_kwargs["ops"] = parse_ops(args.calculator_ops)
+
+    # Build cache ----------------------------------------------------------------------------------
+    # the SoC, gateware sources, DTS and DTB are reused when nothing they depend on changed, and the
+    # bitstream as well when it was built.
+    build_dir    = os.path.join("build", board_name)
+    gateware_dir = os.path.join(build_dir, "gateware")
+    bitstream    = os.path.join(gateware_dir, board_name + board.bitstream_ext)
+    key   = build_key(board_name, soc_kwargs, calculator_kwargs, args)
+    cache = read_cache(build_dir)
+    up_to_date = (not args.no_cache and cache.get("key") == key and
+        os.path.exists(os.path.join(build_dir, "csr.json")) and
+        (not args.build or (cache.get("bitstream") and os.path.exists(bitstream))))
+    if up_to_date:
+        print(f"{board_name}: up to date, reusing {build_dir}")
+        timings["soc"] = time.time() - start
+        timings["cached"] = True
+        if args.load or args.flash:
+            board.create_platform(soc_kwargs)
+    else:
+        build_soc(board_name, board, soc_kwargs, calculator_kwargs, args, timings, start)
+        write_cache(build_dir, {"key": key, "bitstream": args.build or (cache.get("key") == key and cache.get("bitstream", False))})
+
+    # Load FPGA bitstream --------------------------------------------------------------------------
+    if args.load:
+        board.load(filename=bitstream)
+
+    # Flash bitstream/images (to SPI Flash) --------------------------------------------------------
+    if args.flash:
+        board.flash(filename=bitstream)
+
+    return timings
+
+def build_soc(board_name, board, soc_kwargs, calculator_kwargs, args, timings, start):
+    from litex.soc.integration.builder import Builder
+    from linux_on_litex_vexriscv.soc_linux import SoCLinux
+    from calculator_csr import add_calculator
+
+    # SoC creation ---------------------------------------------------------------------------------
+    soc = SoCLinux(board.soc_cls, **soc_kwargs)
+    board.platform = soc.platform
+
+    # SoC constants --------------------------------------------------------------------------------
+    for k, v in board.soc_constants.items():
+        soc.add_constant(k, v)
+
+    # SoC peripherals ------------------------------------------------------------------------------
+    if board_name in ["arty", "arty_a7"]:
+        from litex_boards.platforms.arty import _sdcard_pmod_io
+        board.platform.add_extension(_sdcard_pmod_io)
+
+    if board_name in ["orangecrab"]:
+        from litex_boards.platforms.orangecrab import feather_i2c
+        board.platform.add_extension(feather_i2c)
+
+    if "mmcm" in board.soc_capabilities:
+        soc.add_mmcm(2)
+    if "spiflash" in board.soc_capabilities:
+        soc.add_spi_flash(dummy_cycles=board.SPIFLASH_DUMMY_CYCLES)
+        soc.add_constant("SPIFLASH_PAGE_SIZE", board.SPIFLASH_PAGE_SIZE)
+        soc.add_constant("SPIFLASH_SECTOR_SIZE", board.SPIFLASH_SECTOR_SIZE)
+    if "spisdcard" in board.soc_capabilities:
+        soc.add_spi_sdcard()
+    if "sdcard" in board.soc_capabilities:
+        soc.add_sdcard()
+    if "ethernet" in board.soc_capabilities:
+        soc.configure_ethernet(local_ip=args.local_ip, remote_ip=args.remote_ip)
+    #if "leds" in board.soc_capabilities:
+    #    soc.add_leds()
+    if "rgb_led" in board.soc_capabilities:
+        soc.add_rgb_led()
+    if "switches" in board.soc_capabilities:
+        soc.add_switches()
+    if "spi" in board.soc_capabilities:
+        soc.add_spi(args.spi_data_width, args.spi_clk_freq)
+    if "i2c" in board.soc_capabilities:
+        soc.add_i2c()
+    if "xadc" in board.soc_capabilities:
+        soc.add_xadc()
+    if "icap_bitstream" in board.soc_capabilities:
+        soc.add_icap_bitstream()
+    if "calculator" in board.soc_capabilities:
+        add_calculator(soc, **calculator_kwargs)
+    soc.configure_boot()
+
+    timings["soc"] = time.time() - start
+
+    # Build ----------------------------------------------------------------------------------------
+    build_dir = os.path.join("build", board_name)
+    builder   = Builder(soc,
+        output_dir   = os.path.join("build", board_name),
+        bios_options = ["TERM_MINI"],
+        csr_json     = os.path.join(build_dir, "csr.json"),
+        csr_csv      = os.path.join(build_dir, "csr.csv")
+    )
+    start = time.time()
+    builder.build(run=args.build, build_name=board_name)
+    timings["build"] = time.time() - start
+
+    # DTS ------------------------------------------------------------------------------------------
+    start = time.time()
+    soc.generate_dts(board_name)
+    soc.compile_dts(board_name, args.fdtoverlays)
+
+    # DTB ------------------------------------------------------------------------------------------
+    soc.combine_dtb(board_name, args.fdtoverlays)
+    timings["dtb"] = time.time() - start
+
+    # Generate SoC documentation -------------------------------------------------------------------
+    if args.doc:
+        soc.generate_doc(board_name)
+
 def main():
     description = "Linux on LiteX-VexRiscv\n\n"
     description += "Available boards:\n"
     for name in supported_boards.keys():
         description += "- " + name + "\n"
-    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument("--board",          required=True,            help="FPGA board")
+    epilog = "The VexRiscv CPU options (--cpu-count, --dcache-size, ...) are accepted as well."
+    parser = argparse.ArgumentParser(description=description, epilog=epilog, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--board",          default=None,             help="FPGA board")
     parser.add_argument("--device",         default=None,             help="FPGA device")
     parser.add_argument("--variant",        default=None,             help="FPGA board variant")
     parser.add_argument("--toolchain",      default=None,             help="Toolchain use to build")
@@ -559,8 +803,22 @@ def main():
     parser.add_argument("--spi-data-width", type=int, default=8,      help="SPI data width (maximum transfered bits per xfer)")
     parser.add_argument("--spi-clk-freq",   type=int, default=1e6,    help="SPI clock frequency")
     parser.add_argument("--fdtoverlays",    default="",               help="Device Tree Overlays to apply")
-    VexRiscvSMP.args_fill(parser)
-    args = parser.parse_args()
+    parser.add_argument("--calculator-width", type=int, default=None,   help="Calculator data width (board default)")
+    parser.add_argument("--calculator-depth", type=int, default=None,   help="Calculator memory depth (board default)")
+    parser.add_argument("--calculator-lanes", type=int, default=None,   help="Calculator lanes (board default)")
+    parser.add_argument("--calculator-ops",   default=None,             help="Calculator ops, comma separated (all by default)")
+    parser.add_argument("--jobs",           type=int, default=1,      help="Boards built in parallel with --board all")
+    parser.add_argument("--no-cache",       action="store_true",      help="Regenerate even when build/<board> is up to date")
+    parser.add_argument("--list-boards",    action="store_true",      help="List the supported boards and exit")
+    parser.add_argument("--prepare",        action="store_true",      help="Fetch the third-party sources of the board(s) into build/deps and exit")
+
+    # The CPU options are only added once we know a board is built, VexRiscvSMP is slow to import.
+    args, _ = parser.parse_known_args()
+    if args.list_boards:
+        print("\n".join(supported_boards.keys()))
+        return
+    if args.board is None:
+        parser.error("the following arguments are required: --board")
 
     # Board(s) selection ---------------------------------------------------------------------------
     if args.board == "all":
@@ -570,110 +828,47 @@ def main():
         args.board = args.board.replace(" ", "_")
         board_names = [args.board]
 
+    # Third-party sources --------------------------------------------------------------------------
+    if args.prepare:
+        prepare(board_names)
+        return
+
+    from litex.soc.cores.cpu import VexRiscvSMP
+    VexRiscvSMP.args_fill(parser)
+    args = parser.parse_args()
+
     # Board(s) iteration ---------------------------------------------------------------------------
-    for board_name in board_names:
-        board = supported_boards[board_name]()
-        soc_kwargs = Board.soc_kwargs
-        soc_kwargs.update(board.soc_kwargs)
-
-        # CPU parameters ---------------------------------------------------------------------------
-        # Do memory accesses through Wishbone and L2 cache when L2 size is configured.
-        args.with_wishbone_memory = soc_kwargs["l2_size"] != 0
-        VexRiscvSMP.args_read(args)
-
-        # SoC parameters ---------------------------------------------------------------------------
-        if args.device is not None:
-            soc_kwargs.update(device=args.device)
-        if args.variant is not None:
-            soc_kwargs.update(variant=args.variant)
-        if args.toolchain is not None:
-            soc_kwargs.update(toolchain=args.toolchain)
-        if "usb_fifo" in board.soc_capabilities:
-            soc_kwargs.update(uart_name="usb_fifo")
-        if "usb_acm" in board.soc_capabilities:
-            soc_kwargs.update(uart_name="usb_acm")
-        if "ethernet" in board.soc_capabilities:
-            soc_kwargs.update(with_ethernet=True)
-        if "sata" in board.soc_capabilities:
-            soc_kwargs.update(with_sata=True)
-        if "video_terminal" in board.soc_capabilities:
-            soc_kwargs.update(with_video_terminal=True)
-        if "framebuffer" in board.soc_capabilities:
-            soc_kwargs.update(with_video_framebuffer=True)
-
-        # SoC creation -----------------------------------------------------------------------------
-        soc = SoCLinux(board.soc_cls, **soc_kwargs)
-        board.platform = soc.platform
-
-        # SoC constants ----------------------------------------------------------------------------
-        for k, v in board.soc_constants.items():
-            soc.add_constant(k, v)
-
-        # SoC peripherals --------------------------------------------------------------------------
-        if board_name in ["arty", "arty_a7"]:
-            from litex_boards.platforms.arty import _sdcard_pmod_io
-            board.platform.add_extension(_sdcard_pmod_io)
-
-        if board_name in ["orangecrab"]:
-            from litex_boards.platforms.orangecrab import feather_i2c
-            board.platform.add_extension(feather_i2c)
-
-        if "mmcm" in board.soc_capabilities:
-            soc.add_mmcm(2)
-        if "spiflash" in board.soc_capabilities:
-            soc.add_spi_flash(dummy_cycles=board.SPIFLASH_DUMMY_CYCLES)
-            soc.add_constant("SPIFLASH_PAGE_SIZE", board.SPIFLASH_PAGE_SIZE)
-            soc.add_constant("SPIFLASH_SECTOR_SIZE", board.SPIFLASH_SECTOR_SIZE)
-        if "spisdcard" in board.soc_capabilities:
-            soc.add_spi_sdcard()
-        if "sdcard" in board.soc_capabilities:
-            soc.add_sdcard()
-        if "ethernet" in board.soc_capabilities:
-            soc.configure_ethernet(local_ip=args.local_ip, remote_ip=args.remote_ip)
-        #if "leds" in board.soc_capabilities:
-        #    soc.add_leds()
-        if "rgb_led" in board.soc_capabilities:
-            soc.add_rgb_led()
-        if "switches" in board.soc_capabilities:
-            soc.add_switches()
-        if "spi" in board.soc_capabilities:
-            soc.add_spi(args.spi_data_width, args.spi_clk_freq)
-        if "i2c" in board.soc_capabilities:
-            soc.add_i2c()
-        if "xadc" in board.soc_capabilities:
-            soc.add_xadc()
-        if "icap_bitstream" in board.soc_capabilities:
-            soc.add_icap_bitstream()
-        soc.configure_boot()
-
-        # Build ------------------------------------------------------------------------------------
-        build_dir = os.path.join("build", board_name)
-        builder   = Builder(soc,
-            output_dir   = os.path.join("build", board_name),
-            bios_options = ["TERM_MINI"],
-            csr_json     = os.path.join(build_dir, "csr.json"),
-            csr_csv      = os.path.join(build_dir, "csr.csv")
-        )
-        builder.build(run=args.build, build_name=board_name)
-
-        # DTS --------------------------------------------------------------------------------------
-        soc.generate_dts(board_name)
-        soc.compile_dts(board_name, args.fdtoverlays)
-
-        # DTB --------------------------------------------------------------------------------------
-        soc.combine_dtb(board_name, args.fdtoverlays)
-
-        # Load FPGA bitstream ----------------------------------------------------------------------
-        if args.load:
-            board.load(filename=os.path.join(builder.gateware_dir, soc.build_name + board.bitstream_ext))
-
-        # Flash bitstream/images (to SPI Flash) ----------------------------------------------------
-        if args.flash:
-            board.flash(filename=os.path.join(builder.gateware_dir, soc.build_name + board.bitstream_ext))
-
-        # Generate SoC documentation ---------------------------------------------------------------
-        if args.doc:
-            soc.generate_doc(board_name)
+    # with --jobs, the boards are built in separate processes, each one in its own build/<board_name>
+    results = {}
+    if args.jobs > 1 and len(board_names) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = {board_name: pool.submit(build_board, board_name, args) for board_name in board_names}
+            for board_name, future in futures.items():
+                try:
+                    results[board_name] = future.result()
+                except Exception as e:
+                    results[board_name] = e
+    else:
+        for board_name in board_names:
+            try:
+                results[board_name] = build_board(board_name, args)
+            except Exception as e:
+                if len(board_names) == 1:
+                    raise
+                results[board_name] = e
+
+    # Timing summary -------------------------------------------------------------------------------
+    if len(board_names) > 1:
+        print(f"{'board':<20} {'soc':>8} {'build':>8} {'dtb':>8} {'total':>8}")
+        for board_name, result in results.items():
+            if isinstance(result, Exception):
+                print(f"{board_name:<20} failed: {result}")
+            else:
+                stages = [result.get(stage, 0) for stage in ["soc", "build", "dtb"]]
+                print(f"{board_name:<20} " + " ".join(f"{t:8.1f}" for t in stages) + f" {sum(stages):8.1f}" +
+                    (" cached" if result.get("cached") else ""))
+        if any(isinstance(result, Exception) for result in results.values()):
+            sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -1,63 +1,181 @@
 #!/usr/bin/env python3
+import argparse
+
 from migen import *
 
 class Mem(Module):
-    def __init__(self, width, depth):
-        storage = Memory(width, depth)
+    def __init__(self, width, depth, init=None, dual_port=False):
+        # init is the initial content of locations 0 and up, a list or a NumPy array
+        if init is not None:
+            init = [int(number) for number in init]
+        self.storage = storage = Memory(width, depth, init=init)
         self.specials += storage
 
         self.stored = Signal()
         self.recalled = Signal()
-        self.where_to_store_or_recall = Signal(8)
-        self.number_to_store = Signal(16)
-        self.number_recalled = Signal(16)
+        self.where_to_store_or_recall = Signal(max=depth)
+        self.number_to_store = Signal(width)
+        self.number_recalled = Signal(width)
         self.store_now_active = Signal()
         self.recall_now_active = Signal()
 
+        # with dual_port, stores and recalls have their own address instead of where_to_store_or_recall
+        # and both can happen in the same cycle
+        self.dual_port = dual_port
+        self.store_address = Signal(max=depth)
+        self.recall_address = Signal(max=depth)
+
+        # burst Signals, a burst moves burst_length words to or from burst_address and up, one word per
+        # cycle on a valid/ready stream with no handshake per word. A write burst and a read burst can run
+        # at the same time, the store/recall handshake waits until both are done. With dual_port, a store
+        # only waits for the write burst and a recall for the read burst.
+        self.burst_address = Signal(max=depth)
+        self.burst_length = Signal(max=depth+1)
+        self.burst_write_start = Signal()
+        self.burst_read_start = Signal()
+        self.burst_writing = Signal()
+        self.burst_reading = Signal()
+        self.write_valid = Signal()
+        self.write_ready = Signal()
+        self.write_data = Signal(width)
+        self.read_valid = Signal()
+        self.read_ready = Signal()
+        self.read_data = Signal(width)
+
         ###
 
         #internal signals
         write_port = storage.get_port(write_capable = True)
         read_port = storage.get_port(has_re=True)
+        self.specials += write_port, read_port
+
+        # the ports as driven by the store/recall handshake, the bursts take them over
+        write_address = Signal(max=depth)
+        write_enable = Signal()
+        read_address = Signal(max=depth)
+        read_enable = Signal()
+
+        # burst counters
+        write_next = Signal(max=depth)
+        write_remaining = Signal(max=depth+1)
+        write_accept = Signal()
+        read_next = Signal(max=depth)
+        read_remaining = Signal(max=depth+1)
+        read_issue = Signal()
 
         ###
 
+        if dual_port:
+            self.comb += [
+                write_address.eq(self.store_address),
+                read_address.eq(self.recall_address),
+                write_enable.eq(self.store_now_active & ~self.burst_writing),
+                read_enable.eq(self.recall_now_active & ~self.burst_reading),
+                self.number_recalled.eq(read_port.dat_r)
+            ]
+            self.sync += [
+                self.stored.eq(write_enable),
+                self.recalled.eq(read_enable),
+            ]
+        else:
+            self.comb += [
+                write_address.eq(self.where_to_store_or_recall),
+                read_address.eq(self.where_to_store_or_recall),
+                self.number_recalled.eq(write_port.dat_r)
+            ]
+
+
+            self.sync += [
+                If(self.store_now_active & ~self.recall_now_active & ~self.burst_writing & ~self.burst_reading,
+                    self.stored.eq(1),
+                    write_enable.eq(1),
+                ).Else(
+                    self.stored.eq(0),
+                    write_enable.eq(0)
+                )
+            ]
+
+
+            self.sync += [
+                If(self.recall_now_active & ~self.store_now_active & ~self.burst_writing & ~self.burst_reading,
+                    self.recalled.eq(1),
+                    read_enable.eq(1),
+                ).Else(
+                    self.recalled.eq(0),
+                    read_enable.eq(0)
+                )
+            ]
+
+        # write burst, a word is written in the cycle it is accepted
         self.comb += [
-            write_port.adr.eq(self.where_to_store_or_recall),
-            read_port.adr.eq(self.where_to_store_or_recall),
-            write_port.dat_w.eq(self.number_to_store),
-            self.number_recalled.eq(write_port.dat_r)
+            self.burst_writing.eq(write_remaining != 0),
+            self.write_ready.eq(self.burst_writing),
+            write_accept.eq(self.write_valid & self.write_ready),
         ]
-
-
         self.sync += [
-            If(self.store_now_active & ~self.recall_now_active, 
-                self.stored.eq(1),
-                write_port.we.eq(1),
-            ).Else(
-                self.stored.eq(0),
-                write_port.we.eq(0)
+            If(self.burst_write_start,
+                write_next.eq(self.burst_address),
+                write_remaining.eq(self.burst_length),
+            ).Elif(write_accept,
+                write_next.eq(write_next + 1),
+                write_remaining.eq(write_remaining - 1),
             )
         ]
 
-
+        # read burst, the read port output is the stream data and only moves on when it is taken
+        self.comb += [
+            self.burst_reading.eq((read_remaining != 0) | self.read_valid),
+            read_issue.eq((read_remaining != 0) & (~self.read_valid | self.read_ready)),
+            self.read_data.eq(read_port.dat_r),
+        ]
         self.sync += [
-            If(self.recall_now_active & ~self.store_now_active, 
-                self.recalled.eq(1),
-                read_port.re.eq(1),
+            If(self.burst_read_start,
+                read_next.eq(self.burst_address),
+                read_remaining.eq(self.burst_length),
+                self.read_valid.eq(0),
+            ).Elif(read_issue,
+                read_next.eq(read_next + 1),
+                read_remaining.eq(read_remaining - 1),
+                self.read_valid.eq(1),
+            ).Elif(self.read_ready,
+                self.read_valid.eq(0),
+            )
+        ]
+
+        self.comb += [
+            If(self.burst_writing,
+                write_port.adr.eq(write_next),
+                write_port.dat_w.eq(self.write_data),
+                write_port.we.eq(write_accept),
             ).Else(
-                self.recalled.eq(0),
-                read_port.re.eq(0)
+                write_port.adr.eq(write_address),
+                write_port.dat_w.eq(self.number_to_store),
+                write_port.we.eq(write_enable),
+            ),
+            If(self.burst_reading,
+                read_port.adr.eq(read_next),
+                read_port.re.eq(read_issue),
+            ).Else(
+                read_port.adr.eq(read_address),
+                read_port.re.eq(read_enable),
             )
         ]
 
 
+# every transaction is logged unless the simulation runs with --fast
+verbose = True
+
+def log(*message):
+    if verbose:
+        print(*message)
+
 def tick():
     global t
     t=t+1
     yield
 
-def simulation_story(dut):
+# padding is the number of idle cycles at the end, to see the whole run in the VCD
+def simulation_story(dut, padding=4095):
 
     global t
     t = 0
@@ -83,7 +201,7 @@ def simulation_story(dut):
             raise Exception("Error, did not get stored signal")
 
         yield dut.store_now_active.eq(0)
-        print("stored number is ",(yield dut.where_to_store_or_recall))
+        log("stored number is ",(yield dut.where_to_store_or_recall))
         yield from tick()
 
 
@@ -145,7 +263,7 @@ def simulation_story(dut):
         raise Exception("Error, did not see recalled signal back to 0")
 
     # Lets make sure the number is the same
-    print("Received number is ",(yield dut.number_recalled))
+    log("Received number is ",(yield dut.number_recalled))
     assert( 0x5665 == (yield dut.number_recalled))
 
     yield dut.recall_now_active.eq(0)
@@ -166,7 +284,7 @@ def simulation_story(dut):
         raise Exception("Error, did not see recalledsignal back to 0")
 
     # assert number is 0x222
-    print("Received number is ",(yield dut.number_recalled))
+    log("Received number is ",(yield dut.number_recalled))
     assert( 0x8888 == (yield dut.number_recalled))
 
     yield dut.recall_now_active.eq(0)
@@ -206,7 +324,7 @@ def simulation_story(dut):
         raise Exception("Error, did not see recalledsignal back to 0")
 
     # assert number is 0x222
-    print("Received number is ",(yield dut.number_recalled))
+    log("Received number is ",(yield dut.number_recalled))
     assert( 0x8888 == (yield dut.number_recalled))
 
     yield dut.recall_now_active.eq(0)
@@ -227,15 +345,163 @@ def simulation_story(dut):
         raise Exception("Error, did not see recalledsignal back to 0")
 
     # make sure it is now 0x3333
-    print("Received number is ",(yield dut.number_recalled))
+    log("Received number is ",(yield dut.number_recalled))
     assert( 0x7474 == (yield dut.number_recalled))
 
     yield dut.recall_now_active.eq(0)
     yield from tick()
 
     print("Simulation finished")
-    yield from [None] * 4095
+    yield from [None] * padding
+
+def dual_port_story(dut):
+    # store 1 to 9 in locations 10 to 18 while recalling the location stored the cycle before
+    for i in range(10):
+        yield dut.store_address.eq(10 + i)
+        yield dut.number_to_store.eq(i + 1)
+        yield dut.store_now_active.eq(i < 9)
+        yield dut.recall_address.eq(10 + i - 1)
+        yield dut.recall_now_active.eq(i > 0)
+        yield from tick()
+        if i > 0:
+            yield from tick()
+            if (yield dut.number_recalled) != i:
+                raise Exception(f"recalled {(yield dut.number_recalled)} but was expecting {i}")
+    log("Recalled while storing")
+    print("Dual port simulation finished")
+
+def burst_story(dut):
+    numbers = [3*i + 1 for i in range(12)]
+
+    # write 12 words from location 4, one per cycle
+    yield dut.burst_address.eq(4)
+    yield dut.burst_length.eq(len(numbers))
+    yield dut.burst_write_start.eq(1)
+    yield from tick()
+    yield dut.burst_write_start.eq(0)
+    yield from tick()
+    cycles = 0
+    for number in numbers:
+        yield dut.write_valid.eq(1)
+        yield dut.write_data.eq(number)
+        yield from tick()
+        cycles += 1
+        while not (yield dut.write_ready):
+            yield from tick()
+            cycles += 1
+    yield dut.write_valid.eq(0)
+    yield from tick()
+    if cycles != len(numbers) or (yield dut.burst_writing):
+        raise Exception(f"write burst took {cycles} cycles for {len(numbers)} words")
+
+    # read them back, with the reader stalling every third cycle
+    yield dut.burst_read_start.eq(1)
+    yield from tick()
+    yield dut.burst_read_start.eq(0)
+    yield from tick()
+    # a word moves in a cycle where read_valid and read_ready are both high, read_ready is
+    # the value written the step before
+    received = []
+    ready = 0
+    cycle = 0
+    while (yield dut.burst_reading):
+        if ready and (yield dut.read_valid):
+            received.append((yield dut.read_data))
+        ready = cycle % 3 != 2
+        yield dut.read_ready.eq(ready)
+        yield from tick()
+        cycle += 1
+    yield dut.read_ready.eq(0)
+    if received != numbers:
+        raise Exception(f"read burst got {received} but was expecting {numbers}")
+
+    # the handshake still works after the bursts
+    yield dut.where_to_store_or_recall.eq(9)
+    yield dut.recall_now_active.eq(1)
+    yield from tick()
+    yield from tick()
+    if (yield dut.number_recalled) != numbers[5]:
+        raise Exception("recall after the bursts does not match")
+    yield dut.recall_now_active.eq(0)
+    yield from tick()
+    log("Burst of", len(numbers), "words written in", cycles, "cycles")
+    print("Burst simulation finished")
+
+def set_address(dut, location):
+    yield dut.where_to_store_or_recall.eq(location)
+    yield dut.store_address.eq(location)
+    yield dut.recall_address.eq(location)
+
+def burst_overlap_story(dut):
+    # a store during a write burst is held until the burst is done, not acknowledged and lost
+    yield from set_address(dut, 20)
+    yield dut.number_to_store.eq(0x1234)
+    yield dut.burst_address.eq(0)
+    yield dut.burst_length.eq(4)
+    yield dut.burst_write_start.eq(1)
+    yield from tick()
+    yield dut.burst_write_start.eq(0)
+    yield dut.store_now_active.eq(1)
+    for i in range(4):
+        yield from tick()
+        if (yield dut.stored):
+            raise Exception("store acknowledged during a write burst")
+    for number in range(4):
+        yield dut.write_valid.eq(1)
+        yield dut.write_data.eq(number + 1)
+        yield from tick()
+    yield dut.write_valid.eq(0)
+    for i in range(10):
+        if (yield dut.stored):
+            break
+        yield from tick()
+    else:
+        raise Exception("store not done after the write burst")
+    yield dut.store_now_active.eq(0)
+    yield from tick()
+
+    # a recall during a stalled read burst is held as well, then gets its own location
+    yield dut.burst_read_start.eq(1)
+    yield from tick()
+    yield dut.burst_read_start.eq(0)
+    yield dut.recall_now_active.eq(1)
+    for i in range(4):
+        yield from tick()
+        if (yield dut.recalled):
+            raise Exception("recall acknowledged during a read burst")
+    yield dut.read_ready.eq(1)
+    for i in range(20):
+        if (yield dut.recalled):
+            break
+        yield from tick()
+    else:
+        raise Exception("recall not done after the read burst")
+    yield dut.read_ready.eq(0)
+    if (yield dut.number_recalled) != 0x1234:
+        raise Exception(f"recalled {(yield dut.number_recalled):#x} but was expecting 0x1234")
+    yield dut.recall_now_active.eq(0)
+    yield from tick()
+    log("Store and recall held during the bursts")
+    print("Burst overlap simulation finished")
 
 if __name__ == "__main__":
-    dut = Mem(16, 16)
-    run_simulation(dut, simulation_story(dut), vcd_name="test_memoryy.vcd")
+    parser = argparse.ArgumentParser(description="Mem simulation")
+    parser.add_argument("--fast", action="store_true", help="No VCD file, no per-transaction logging and no idle cycles at the end")
+    args = parser.parse_args()
+    verbose = not args.fast
+
+    dut = Mem(16, 128)
+    if args.fast:
+        run_simulation(dut, simulation_story(dut, padding=0))
+    else:
+        run_simulation(dut, simulation_story(dut), vcd_name="test_memoryy.vcd")
+
+    dut = Mem(16, 32)
+    run_simulation(dut, burst_story(dut), vcd_name=None if args.fast else "test_memory_burst.vcd")
+
+    dut = Mem(16, 32, dual_port=True)
+    run_simulation(dut, dual_port_story(dut), vcd_name=None if args.fast else "test_memory_dual_port.vcd")
+
+    for dual_port in [False, True]:
+        dut = Mem(16, 32, dual_port=dual_port)
+        run_simulation(dut, burst_overlap_story(dut))
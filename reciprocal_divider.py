@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+import argparse
+
+from migen import *
+from migen.genlib.divider import Divider
+from migen.genlib.fsm import FSM
+
+# Same ports and results as migen's Divider. The reciprocal of the divisor is computed once
+# with a restoring divider and kept, every following division by the same divisor is a
+# multiply, a shift and one correction step, ready two cycles after start_i.
+class ReciprocalDivider(Module):
+    def __init__(self, w):
+        self.start_i = Signal()
+        self.dividend_i = Signal(w)
+        self.divisor_i = Signal(w)
+        self.ready_o = Signal()
+        self.quotient_o = Signal(w)
+        self.remainder_o = Signal(w)
+
+        ###
+
+        # reciprocal = floor((2**(w+1) - 1) / divisor), with w+1 fractional bits
+        # the estimated quotient is never too big and at most one too small
+        shift = w + 1
+        self.submodules.reciprocal_divider = reciprocal_divider = Divider(w+1)
+        reciprocal = Signal(w+1)
+        cached_divisor = Signal(w)
+        cached = Signal()
+
+        dividend = Signal(w)
+        divisor = Signal(w)
+        estimate = Signal(w)
+        leftover = Signal(w+1)
+
+        self.comb += [
+            reciprocal_divider.dividend_i.eq(2**shift - 1),
+            reciprocal_divider.divisor_i.eq(divisor),
+            leftover.eq(dividend - estimate*divisor),
+        ]
+
+        fsm = FSM(reset_state="IDLE")
+        self.submodules += fsm
+
+        fsm.act("IDLE",
+            self.ready_o.eq(1),
+            If(self.start_i,
+                NextValue(dividend,self.dividend_i),
+                NextValue(divisor,self.divisor_i),
+                If(cached & (cached_divisor == self.divisor_i),
+                    NextState("multiplying"),
+                ).Else(
+                    NextValue(cached,0),
+                    NextState("reciprocal"),
+                ),
+            ),
+        )
+
+        fsm.act("reciprocal",
+            reciprocal_divider.start_i.eq(1),
+            NextState("reciprocal_wait"),
+        )
+
+        fsm.act("reciprocal_wait",
+            If(reciprocal_divider.ready_o,
+                NextValue(reciprocal,reciprocal_divider.quotient_o),
+                NextValue(cached_divisor,divisor),
+                NextValue(cached,1),
+                NextState("multiplying"),
+            ),
+        )
+
+        fsm.act("multiplying",
+            NextValue(estimate,(dividend*reciprocal) >> shift),
+            NextState("correcting"),
+        )
+
+        # same convention as Divider for a zero divisor: all ones, remainder is the dividend
+        fsm.act("correcting",
+            If(divisor == 0,
+                NextValue(self.quotient_o,2**w - 1),
+                NextValue(self.remainder_o,dividend),
+            ).Elif(leftover >= divisor,
+                NextValue(self.quotient_o,estimate + 1),
+                NextValue(self.remainder_o,leftover - divisor),
+            ).Else(
+                NextValue(self.quotient_o,estimate),
+                NextValue(self.remainder_o,leftover),
+            ),
+            NextState("IDLE"),
+        )
+
+# every division is logged unless the simulation runs with --fast
+verbose = True
+
+def log(message):
+    if verbose:
+        print(message)
+
+def tick():
+    yield
+
+def divide(dut, dividend, divisor):
+    yield dut.dividend_i.eq(dividend)
+    yield dut.divisor_i.eq(divisor)
+    yield dut.start_i.eq(1)
+    yield from tick()
+    yield dut.start_i.eq(0)
+    yield from tick()
+
+    cycles = 1
+    MAX_WAIT_CYCLES=100
+    for i in range(MAX_WAIT_CYCLES):
+        if (yield dut.ready_o):
+            break
+        yield from tick()
+        cycles += 1
+    if i==(MAX_WAIT_CYCLES-1):
+        raise Exception("Timeout waiting for division to be done")
+
+    return (yield dut.quotient_o), (yield dut.remainder_o), cycles
+
+def simulation_story(dut, width):
+    cases = [(24, 3), (33, 3), (906, 3), (907, 3), (0, 7), (2**width - 1, 1),
+             (2**width - 1, 2**width - 1), (12345, 1000), (12346, 1000), (5, 0)]
+    for dividend, divisor in cases:
+        quotient, remainder, cycles = yield from divide(dut, dividend, divisor)
+        if divisor == 0:
+            expected = (2**width - 1, dividend)
+        else:
+            expected = (dividend // divisor, dividend % divisor)
+        log(f'{dividend} / {divisor} = {quotient} remainder {remainder} in {cycles} cycles')
+        if (quotient, remainder) != expected:
+            raise Exception(f"division is not correct. Got {(quotient, remainder)} but was expecting {expected}")
+
+    # sweep the dividend range against a few divisors
+    for divisor in [3, 7, 10, 255]:
+        for dividend in range(0, 2**width, 97):
+            quotient, remainder, cycles = yield from divide(dut, dividend, divisor)
+            if (quotient, remainder) != (dividend // divisor, dividend % divisor):
+                raise Exception(f"{dividend} / {divisor} is not correct. Got {(quotient, remainder)}")
+
+    print("Simulation finished")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ReciprocalDivider simulation")
+    parser.add_argument("--fast", action="store_true", help="No VCD file and no per-division logging")
+    args = parser.parse_args()
+    verbose = not args.fast
+
+    dut = ReciprocalDivider(16)
+    run_simulation(dut, simulation_story(dut, 16), vcd_name=None if args.fast else "reciprocal_divider.vcd")
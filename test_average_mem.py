@@ -1,213 +1,28 @@
 #!/usr/bin/env python3
+import argparse
+
 from migen import *
-from migen.genlib.divider import Divider
-from migen.genlib.fsm import FSM
-
-class Calculator(Module):
-    def __init__(self, width, depth):
-
-        # Submodules
-        storage = Memory(width, depth)
-        self.specials += storage
-        self.submodules.divider = divider = Divider(width)
-
-        # storage Signals
-        self.stored = Signal()
-        self.recalled = Signal()
-        self.where_to_store_or_recall = Signal(width)
-        self.number_to_store = Signal(width)
-        self.number_recalled = Signal(width)
-        self.store_now_active = Signal()
-        self.recall_now_active = Signal()
-
-        # calculation Signals
-        self.calculate_now_active = Signal()
-        self.summed_number = Signal(width)
-        self.calculated = Signal()
-        self.result = Signal(width)
-
-        # division Signals
-        self.start_division = Signal()
-        self.division_finished = Signal()
-        self.result = Signal(width)
-        self.leftover = Signal(width)
-        self.dividing = Signal()
-        self.divide_by = Signal(width)
-
-        #internal signals
-        write_port = storage.get_port(write_capable = True)
-        read_port = storage.get_port(has_re=True)
-        number_recalled_internal = Signal(width)
-        counter = Signal(width)
-
-        ###
-
-        self.comb += [
-            write_port.adr.eq(self.where_to_store_or_recall),
-            read_port.adr.eq(self.where_to_store_or_recall),
-            write_port.dat_w.eq(self.number_to_store),
-            self.number_recalled.eq(write_port.dat_r)
-        ]
-
-
-        self.sync += [
-            If(self.store_now_active & ~self.recall_now_active,
-                self.stored.eq(1),
-                write_port.we.eq(1),
-            ).Else(
-                self.stored.eq(0),
-                write_port.we.eq(0)
-            )
-        ]
-
-
-        self.sync += [
-            If(self.recall_now_active & ~self.store_now_active,
-                self.recalled.eq(1),
-                read_port.re.eq(1),
-            ).Else(
-                self.recalled.eq(0),
-                read_port.re.eq(0)
-            )
-        ]
-
-#        self.sync += [
-#            If(self.summed_number == 24,[
-#                If(self.start_division & ~self.dividing, [
-#                   divider.start_i.eq(1), # start the divider module
-#                   divider.dividend_i.eq(self.summed_number),
-#                   divider.divisor_i.eq(3),
-#                   self.dividing.eq(1),
-#                ]).Else([
-#                    divider.start_i.eq(0),
-#                ]),
-#                If(self.divider.ready_o & self.dividing & ~self.start_division, [
-#                   self.result.eq(divider.quotient_o),
-#                   self.leftover.eq(divider.remainder_o),
-#                   self.division_finished.eq(1),
-#                   self.dividing.eq(0),
-#                ])
-#            ])
-#        ]
-
-
-        ###
-
-        # FSM
-        fsm = FSM(reset_state="RESET")
-        self.submodules += fsm
-
-        fsm.act("RESET",
-                NextState("INACTIVE")
-        )
-
-        fsm.act("INACTIVE",
-            NextValue(counter,0),
-            NextValue(self.calculated,0),
-            NextValue(self.summed_number,0),
-            NextValue(self.result,0),
-            If((self.store_now_active == 1) & (self.recall_now_active == 0),
-               NextState("storing"),
-            ).Elif((self.recall_now_active == 1) & (self.store_now_active == 0),
-               NextState("recalling"),
-            ).Elif((self.calculate_now_active == 1),
-                NextState("calculating"),
-            ),
-        )
-
-        #calculation
-        #addition, assuming recall is done in one cycle!
-        fsm.act("calculating",
-            NextValue(self.recall_now_active,0),
-            NextState("summing"),
-        )
-
-        fsm.act("summing",
-            If(self.recalled == 0,
-                NextValue(self.recall_now_active,1),
-                NextValue(self.store_now_active,0),
-                NextValue(counter,counter+1),
-                NextValue(self.where_to_store_or_recall,0),
-            ).Elif((counter < self.divide_by),
-                If(self.recalled==1,
-                   number_recalled_internal.eq(self.number_recalled),
-                   NextValue(self.summed_number,self.summed_number + number_recalled_internal),
-                   NextValue(self.where_to_store_or_recall,self.where_to_store_or_recall + 1),
-                   If(self.where_to_store_or_recall == 4,
-                       NextValue(self.recalled,0),
-                   ),
-                ),
-            ).Elif((counter == self.divide_by),
-                NextValue(self.calculated,0),
-                NextValue(self.start_division,1),
-                NextValue(self.dividing,0),
-                NextState("division"),
-            ),
-        )
-
-
-        fsm.act("division",
-            NextValue(divider.start_i,1),
-            NextValue(divider.dividend_i,self.summed_number),
-            NextValue(divider.divisor_i,self.divide_by),
-            NextValue(self.dividing,1),
-            NextValue(self.start_division,0),
-            NextState("dividing"),
-        )
-
-        fsm.act("dividing",
-                NextValue(divider.start_i,0),
-                If(self.divider.ready_o & ~divider.start_i,
-                   NextState("output_is_ready"),
-                   NextValue(self.result,divider.quotient_o),
-               )
-        )
-        fsm.act("output_is_ready",
-            NextValue(divider.start_i,0),
-            NextValue(self.dividing,0),
-            NextValue(self.calculated,1),
-            NextValue(self.recall_now_active,0),
-            NextValue(self.number_to_store,self.result),
-            NextState("storing_result"),
-        )
-
-        fsm.act("storing_result",
-            NextValue(self.recall_now_active,0),
-            NextValue(self.store_now_active,1),
-            NextValue(self.where_to_store_or_recall,4),
-            If(self.where_to_store_or_recall == 4,
-                If(self.stored == 1,
-                    NextValue(self.store_now_active,0),
-                    NextState("INACTIVE"),
-                ),
-            ),
-        )
-
-        #storing
-        fsm.act("storing",
-            If((self.stored == 1) | (self.store_now_active == 0) & (self.recall_now_active == 0),
-                NextState("INACTIVE"),
-            ),
-        )
-
-        #recalling
-        fsm.act("recalling" ,
-            If(self.recalled == 1 | (self.store_now_active == 0) & (self.recall_now_active == 0),
-                NextState("INACTIVE"),
-            ),
-        )
+
+from calculator import *
+
+# every transaction is logged unless the simulation runs with --fast
+verbose = True
+
+def log(message):
+    if verbose:
+        print(message)
 
 def tick():
     yield
 
 # Helper functions for simulation
 def wait_for(cycles):
-    print(f'Waiting for {cycles} cycles')
+    log(f'Waiting for {cycles} cycles')
     for i in range(cycles):
         yield from tick()
 
 def wait_storage_available(dut):
-    print(f'Waiting for storage to be available')
+    log(f'Waiting for storage to be available')
     # Wait until the number storage facility is available
     MAX_WAIT_CYCLES=20
     for i in range(MAX_WAIT_CYCLES):
@@ -219,7 +34,7 @@ def wait_storage_available(dut):
         raise Exception("Timeout waiting for storage to become available")
 
 def wait_calculator_available(dut):
-    print(f'Waiting for calculator to be available')
+    log(f'Waiting for calculator to be available')
     # Wait until the calculator is available
     MAX_WAIT_CYCLES=20
     for i in range(MAX_WAIT_CYCLES):
@@ -230,12 +45,16 @@ def wait_calculator_available(dut):
         raise Exception("Timeout waiting for calculator to become available")
 
 
-def calculate(dut):
+def calculate(dut, start_address=0, element_count=4, result_address=4, divide_by=3, op=OP_AVERAGE):
     yield from wait_calculator_available(dut)
-    print(f'Doing calculation')
+    log(f'Doing calculation')
 
+    yield dut.op.eq(op)
+    yield dut.start_address.eq(start_address)
+    yield dut.element_count.eq(element_count)
+    yield dut.result_address.eq(result_address)
+    yield dut.divide_by.eq(divide_by)
     yield dut.calculate_now_active.eq(1)
-    yield dut.divide_by.eq(3)
     # Wait until calculation is done
     MAX_WAIT_CYCLES=100
     for i in range(MAX_WAIT_CYCLES):
@@ -250,11 +69,81 @@ def calculate(dut):
     yield from tick()
 
 
+def calculate_stream(dut, numbers, result_address, divide_by):
+    yield from wait_calculator_available(dut)
+    log(f'Doing calculation on {len(numbers)} streamed numbers')
+
+    yield dut.op.eq(OP_AVERAGE)
+    yield dut.from_stream.eq(1)
+    yield dut.stream_count.eq(len(numbers))
+    yield dut.result_address.eq(result_address)
+    yield dut.divide_by.eq(divide_by)
+    yield dut.calculate_now_active.eq(1)
+    for number in numbers:
+        yield dut.stream_valid.eq(1)
+        yield dut.stream_data.eq(number)
+        yield from tick()
+        while (yield dut.stream_ready) == 0:
+            yield from tick()
+    yield dut.stream_valid.eq(0)
+
+    # Wait until calculation is done
+    MAX_WAIT_CYCLES=100
+    for i in range(MAX_WAIT_CYCLES):
+        if (yield dut.calculated == 1):
+            break
+        yield from tick()
+    if i==(MAX_WAIT_CYCLES-1):
+        raise Exception("Timeout waiting for calculation to be done")
+
+    yield dut.calculate_now_active.eq(0)
+    yield dut.from_stream.eq(0)
+    yield from tick()
+
+def push_job(dut, start_address, element_count, result_address, divide_by, op=OP_AVERAGE):
+    log(f'Queuing average of {element_count} numbers from location {start_address} into location {result_address}')
+    MAX_WAIT_CYCLES=20
+    for i in range(MAX_WAIT_CYCLES):
+        if (yield dut.job_writable):
+            break
+        yield from tick()
+    if i==(MAX_WAIT_CYCLES-1):
+        raise Exception("Timeout waiting for the job queue to have room")
+
+    yield dut.job_start_address.eq(start_address)
+    yield dut.job_element_count.eq(element_count)
+    yield dut.job_result_address.eq(result_address)
+    yield dut.job_divide_by.eq(divide_by)
+    yield dut.job_op.eq(op)
+    yield dut.job_push.eq(1)
+    yield from tick()
+    yield dut.job_push.eq(0)
+
+def run_batch(dut):
+    yield from wait_calculator_available(dut)
+    log(f'Running queued jobs')
+
+    yield dut.run_batch.eq(1)
+    # Wait until every queued job is done
+    MAX_WAIT_CYCLES=1000
+    for i in range(MAX_WAIT_CYCLES):
+        if (yield dut.batch_done == 1):
+            break
+        yield from tick()
+    if i==(MAX_WAIT_CYCLES-1):
+        raise Exception("Timeout waiting for the batch to be done")
+
+    yield dut.run_batch.eq(0)
+    yield from tick()
+
 def store_number(dut, number_to_store, location):
     yield from wait_storage_available(dut)
-    print(f'Storing { number_to_store} in location { location}.')
+    log(f'Storing { number_to_store} in location { location}.')
     # Load a number into storage
-    yield dut.where_to_store_or_recall.eq(location)
+    if dut.dual_port:
+        yield dut.store_address.eq(location)
+    else:
+        yield dut.where_to_store_or_recall.eq(location)
     yield dut.number_to_store.eq(number_to_store)
     yield from tick()
     yield dut.store_now_active.eq(1)
@@ -274,9 +163,12 @@ def store_number(dut, number_to_store, location):
 
 def recall_number(dut,location):
     yield from wait_storage_available(dut)
-    print(f'Recalling number in location { location}.')
+    log(f'Recalling number in location { location}.')
     # Load a number into storage
-    yield dut.where_to_store_or_recall.eq(location)
+    if dut.dual_port:
+        yield dut.recall_address.eq(location)
+    else:
+        yield dut.where_to_store_or_recall.eq(location)
     yield dut.recall_now_active.eq(1)
     yield from tick()
 
@@ -289,13 +181,28 @@ def recall_number(dut,location):
         raise Exception("Timeout waiting for number to be recalled")
 
     number_recalled =     yield dut.number_recalled
-    print(f'Recalled number in location { location} is { number_recalled }.')
+    log(f'Recalled number in location { location} is { number_recalled }.')
 
     yield dut.recall_now_active.eq(0)
     yield from tick()
 
     return (yield dut.number_recalled)
 
+# Bulk load and dump, straight to the Memory contents with no handshake and no clock cycle.
+# banks is dut.banks for the calculator or [dut.storage] for Mem, numbers a list or a NumPy array.
+# Like any write from a generator, the loaded numbers can be read back from the next cycle.
+def load_memory(banks, numbers, location=0):
+    lanes = len(banks)
+    for address, number in enumerate(numbers, start=location):
+        yield banks[address % lanes][address // lanes].eq(int(number))
+
+def dump_memory(banks, location, count):
+    lanes = len(banks)
+    numbers = []
+    for address in range(location, location + count):
+        numbers.append((yield banks[address % lanes][address // lanes]))
+    return numbers
+
 def simulation_story(dut):
     print('Starting simulation')
 
@@ -363,5 +270,387 @@ def simulation_story(dut):
 
     print('Final simulation ended successfully')
 
-dut = Calculator(16,5)
-run_simulation(dut, simulation_story(dut), vcd_name="test_average_mem.vcd")
+
+    # Average a window that does not start at location 0 and store it elsewhere
+    yield from calculate(dut, start_address=1, element_count=3, result_address=0, divide_by=3)
+
+    r = yield from recall_number(dut,location=0)
+    if (r != 302):
+        raise Exception(f"windowed average is not calculated correctly. Got {r} but was expecting 302")
+
+    print('Windowed simulation ended successfully')
+
+
+    # Queue several averages and run them with a single handshake, each job sees the results of the previous ones
+    yield from push_job(dut, start_address=1, element_count=2, result_address=0, divide_by=2)
+    yield from push_job(dut, start_address=2, element_count=2, result_address=4, divide_by=2)
+    yield from push_job(dut, start_address=0, element_count=2, result_address=0, divide_by=2)
+    yield from run_batch(dut)
+
+    r = yield from recall_number(dut,location=0)
+    if (r != 325):
+        raise Exception(f"batched average is not calculated correctly. Got {r} but was expecting 325")
+    r = yield from recall_number(dut,location=4)
+    if (r != 303):
+        raise Exception(f"batched average is not calculated correctly. Got {r} but was expecting 303")
+
+    print('Batch simulation ended successfully')
+
+
+    # Average numbers coming from a stream instead of the storage
+    yield from calculate_stream(dut, [10, 20, 30, 40, 50, 60], result_address=2, divide_by=6)
+
+    r = yield from recall_number(dut,location=2)
+    if (r != 35):
+        raise Exception(f"streamed average is not calculated correctly. Got {r} but was expecting 35")
+
+    print('Stream simulation ended successfully')
+
+
+    # Every aggregate comes out of the same pass, op only picks the one stored in memory
+    yield from store_number(dut, 4, location=0)
+    yield from store_number(dut, 9, location=1)
+    yield from store_number(dut, 2, location=2)
+    yield from store_number(dut, 7, location=3)
+    yield from calculate(dut, start_address=0, element_count=4, result_address=4, op=OP_MAX)
+
+    aggregates = ((yield dut.summed_number), (yield dut.minimum), (yield dut.maximum),
+                  (yield dut.counted), (yield dut.sum_of_squares))
+    if aggregates != (22, 2, 9, 4, 150):
+        raise Exception(f"aggregates are not calculated correctly. Got {aggregates} but was expecting (22, 2, 9, 4, 150)")
+
+    r = yield from recall_number(dut,location=4)
+    if (r != 9):
+        raise Exception(f"maximum is not calculated correctly. Got {r} but was expecting 9")
+
+    for op, expected in [(OP_SUM, 22), (OP_MIN, 2), (OP_COUNT, 4), (OP_SUM_OF_SQUARES, 150)]:
+        yield from calculate(dut, start_address=0, element_count=4, result_address=4, op=op)
+        r = yield from recall_number(dut,location=4)
+        if (r != expected):
+            raise Exception(f"aggregate {op} is not calculated correctly. Got {r} but was expecting {expected}")
+
+    print('Aggregates simulation ended successfully')
+
+    yield from overflow_story(dut)
+    yield from counters_story(dut, jobs=14, elements=50)
+
+def overflow_story(dut):
+    # A sum wider than the stored numbers, it only fits when the accumulator is wider than them
+    yield from store_number(dut, 40000, location=1)
+    yield from store_number(dut, 40000, location=2)
+    yield from store_number(dut, 1000, location=3)
+    yield from calculate(dut, start_address=1, element_count=3, result_address=0, divide_by=3)
+
+    r = yield from recall_number(dut,location=0)
+    overflow = yield dut.overflow
+    if len(dut.summed_number) > 16:
+        if (r, overflow) != (27000, 0):
+            raise Exception(f"wide sum is not calculated correctly. Got {r} and overflow {overflow} but was expecting 27000")
+    else:
+        if (r, overflow) != (21845, 1):
+            raise Exception(f"sum did not saturate. Got {r} and overflow {overflow} but was expecting 21845 and overflow")
+
+    print('Overflow simulation ended successfully')
+
+def row_overflow_story(dut):
+    # A whole row of large numbers, with lanes it is added in one cycle
+    for location in range(4, 8):
+        yield from store_number(dut, 40000, location=location)
+    yield from calculate(dut, start_address=4, element_count=4, result_address=0, divide_by=4)
+
+    r = yield from recall_number(dut,location=0)
+    overflow = yield dut.overflow
+    if len(dut.summed_number) > 17:
+        if (r, overflow) != (40000, 0):
+            raise Exception(f"wide row sum is not calculated correctly. Got {r} and overflow {overflow} but was expecting 40000")
+    else:
+        if (r, overflow) != (16383, 1):
+            raise Exception(f"row sum did not saturate. Got {r} and overflow {overflow} but was expecting 16383 and overflow")
+
+    print('Row overflow simulation ended successfully')
+
+def counters_story(dut, jobs, elements):
+    # Every job of the story so far writes its result once
+    counters = ((yield dut.jobs_completed), (yield dut.storing_result_cycles), (yield dut.elements_processed))
+    if counters != (jobs, jobs, elements):
+        raise Exception(f"performance counters are not correct. Got {counters} but was expecting {(jobs, jobs, elements)}")
+
+    states = []
+    for counter in [dut.summing_cycles, dut.division_cycles, dut.dividing_cycles, dut.storing_result_cycles]:
+        states.append((yield counter))
+    busy = yield dut.busy_cycles
+    if sum(states) > busy:
+        raise Exception(f"state counters {states} add up to more than the {busy} busy cycles")
+    log(f'{busy} busy cycles, {states} in summing, division, dividing and storing_result')
+
+    yield dut.clear_counters.eq(1)
+    yield from tick()
+    yield dut.clear_counters.eq(0)
+    yield from tick()
+    if (yield dut.busy_cycles) != 0 or (yield dut.jobs_completed) != 0:
+        raise Exception("performance counters did not clear")
+
+    print('Counters simulation ended successfully')
+
+def bulk_story(dut, init):
+    # The initial content comes from init
+    numbers = yield from dump_memory(dut.banks, 0, len(init))
+    if numbers != list(init):
+        raise Exception(f"initial content is not correct. Got {numbers} but was expecting {list(init)}")
+
+    yield from load_memory(dut.banks, [10, 20, 30, 40, 50, 60], location=1)
+    yield from tick()
+    if (yield from recall_number(dut, location=6)) != 60:
+        raise Exception("bulk loaded number in location 6 does not match")
+
+    # Average locations 1 to 6 by 6 into location 0
+    yield from calculate(dut, start_address=1, element_count=6, result_address=0, divide_by=6)
+    numbers = yield from dump_memory(dut.banks, 0, 2)
+    if numbers != [35, 10]:
+        raise Exception(f"bulk dump is not correct. Got {numbers} but was expecting [35, 10]")
+
+    print('Bulk simulation ended successfully')
+
+def dual_port_story(dut):
+    yield from load_memory(dut.banks, [4, 8, 15, 16])
+    yield from tick()
+
+    # Start averaging locations 0 to 3 into location 4 and keep the host busy meanwhile
+    yield dut.start_address.eq(0)
+    yield dut.element_count.eq(4)
+    yield dut.result_address.eq(4)
+    yield dut.divide_by.eq(4)
+    yield dut.op.eq(OP_AVERAGE)
+    yield dut.calculate_now_active.eq(1)
+    yield from tick()
+
+    # Store the next dataset in locations 5 to 7 while recalling location 0, in the same cycles
+    for location, number in [(5, 23), (6, 42), (7, 108)]:
+        yield dut.store_address.eq(location)
+        yield dut.number_to_store.eq(number)
+        yield dut.store_now_active.eq(1)
+        yield dut.recall_address.eq(0)
+        yield dut.recall_now_active.eq(1)
+        yield from tick()
+        while not (yield dut.stored):
+            yield from tick()
+        if not (yield dut.recalled) or (yield dut.number_recalled) != 4:
+            raise Exception("recall in the same cycle as a store did not return location 0")
+        if (yield dut.calculated):
+            raise Exception("calculation finished before the stores, they did not overlap")
+        yield dut.store_now_active.eq(0)
+        yield dut.recall_now_active.eq(0)
+        yield from tick()
+
+    MAX_WAIT_CYCLES=100
+    for i in range(MAX_WAIT_CYCLES):
+        if (yield dut.calculated):
+            break
+        yield from tick()
+    if i==(MAX_WAIT_CYCLES-1):
+        raise Exception("Timeout waiting for calculation to be done")
+    yield dut.calculate_now_active.eq(0)
+    yield from tick()
+
+    numbers = yield from dump_memory(dut.banks, 4, 4)
+    if numbers != [10, 23, 42, 108]:
+        raise Exception(f"dual port stores or result are not correct. Got {numbers} but was expecting [10, 23, 42, 108]")
+
+    print('Dual port simulation ended successfully')
+
+def store_during_result_story(dut):
+    # a store that lands in the cycle the result is written back has to wait, not be acknowledged
+    # and lost. The store is moved one cycle later each round, past the write back.
+    for delay in range(40):
+        yield from load_memory(dut.banks, [4, 8, 15, 16, 0, 0])
+        yield dut.start_address.eq(0)
+        yield dut.element_count.eq(4)
+        yield dut.result_address.eq(4)
+        yield dut.divide_by.eq(4)
+        yield dut.op.eq(OP_AVERAGE)
+        yield dut.calculate_now_active.eq(1)
+        yield from tick()
+        yield from wait_for(delay)
+
+        # the store is held for one cycle at a time and asked again until it is stored
+        yield dut.where_to_store_or_recall.eq(5)
+        yield dut.store_address.eq(5)
+        yield dut.number_to_store.eq(100 + delay)
+        stored = 0
+        while not stored:
+            yield dut.store_now_active.eq(1)
+            yield from tick()
+            yield dut.store_now_active.eq(0)
+            yield from tick()
+            stored = yield dut.stored
+
+        MAX_WAIT_CYCLES=100
+        for i in range(MAX_WAIT_CYCLES):
+            if (yield dut.calculated):
+                break
+            yield from tick()
+        if i==(MAX_WAIT_CYCLES-1):
+            raise Exception("Timeout waiting for calculation to be done")
+        yield dut.calculate_now_active.eq(0)
+        yield from tick()
+        yield from tick()
+
+        numbers = yield from dump_memory(dut.banks, 4, 2)
+        if numbers != [10, 100 + delay]:
+            raise Exception(f"store {delay} cycles into a calculation is lost. Got {numbers} but was expecting [10, {100 + delay}]")
+
+    print('Store during result simulation ended successfully')
+
+def recall_during_result_story(dut):
+    # a recall whose read lands in the cycle the result is written back has to wait instead of
+    # returning the result. The recall is moved one cycle later each round, past the write back.
+    for delay in range(40):
+        yield from load_memory(dut.banks, [4, 8, 15, 16, 0, 0, 77])
+        yield dut.start_address.eq(0)
+        yield dut.element_count.eq(4)
+        yield dut.result_address.eq(4)
+        yield dut.divide_by.eq(4)
+        yield dut.op.eq(OP_AVERAGE)
+        yield dut.calculate_now_active.eq(1)
+        yield from tick()
+        yield from wait_for(delay)
+
+        yield dut.where_to_store_or_recall.eq(6)
+        yield dut.recall_address.eq(6)
+        yield dut.recall_now_active.eq(1)
+        yield from tick()
+        while not (yield dut.recalled):
+            yield from tick()
+        recalled = yield dut.number_recalled
+        yield dut.recall_now_active.eq(0)
+        yield from tick()
+        if recalled != 77:
+            raise Exception(f"recall {delay} cycles into a calculation got {recalled} but was expecting 77")
+
+        MAX_WAIT_CYCLES=100
+        for i in range(MAX_WAIT_CYCLES):
+            if (yield dut.calculated):
+                break
+            yield from tick()
+        if i==(MAX_WAIT_CYCLES-1):
+            raise Exception("Timeout waiting for calculation to be done")
+        yield dut.calculate_now_active.eq(0)
+        yield from tick()
+        yield from tick()
+
+    print('Recall during result simulation ended successfully')
+
+def swap_buffers(dut):
+    yield dut.swap.eq(1)
+    yield from tick()
+    yield dut.swap.eq(0)
+    yield from tick()
+
+def double_buffer_story(dut):
+    # Fill the host buffer and hand it over to the calculator
+    for location, number in enumerate([1, 2, 3, 4]):
+        yield from store_number(dut, number, location)
+    yield from swap_buffers(dut)
+
+    # Average it into location 0 while the host fills the other buffer
+    yield dut.start_address.eq(0)
+    yield dut.element_count.eq(4)
+    yield dut.result_address.eq(0)
+    yield dut.divide_by.eq(4)
+    yield dut.op.eq(OP_AVERAGE)
+    yield dut.calculate_now_active.eq(1)
+    for location, number in enumerate([10, 20, 30, 40]):
+        yield from store_number(dut, number, location)
+    if (yield dut.calculated):
+        raise Exception("calculation finished before the stores, they did not overlap")
+
+    # A swap asked for during the calculation waits for it to be done
+    yield dut.swap.eq(1)
+    yield from tick()
+    yield dut.swap.eq(0)
+    MAX_WAIT_CYCLES=100
+    for i in range(MAX_WAIT_CYCLES):
+        if (yield dut.calculated):
+            break
+        yield from tick()
+    if i==(MAX_WAIT_CYCLES-1):
+        raise Exception("Timeout waiting for calculation to be done")
+    yield dut.calculate_now_active.eq(0)
+    yield from tick()
+    yield from tick()
+
+    # The second dataset is now calculated on and the first one, with its result, is back with the host
+    yield from calculate(dut, start_address=0, element_count=4, result_address=0, divide_by=4)
+    if (yield from recall_number(dut, location=0)) != 2:
+        raise Exception("result of the first buffer is not correct")
+    yield from swap_buffers(dut)
+    r = yield from recall_number(dut, location=0)
+    if r != 25:
+        raise Exception(f"average of the second buffer is not correct. Got {r} but was expecting 25")
+
+    print('Double buffer simulation ended successfully')
+
+def ops_story(dut):
+    # Only the sum and the maximum are built, an op left out writes nothing back and sets unsupported_op
+    for location, number in enumerate([4, 9, 2, 7]):
+        yield from store_number(dut, number, location)
+    yield from store_number(dut, 1234, location=4)
+    for op, expected, unsupported in [(OP_MAX, 9, 0), (OP_COUNT, 9, 1), (OP_SUM, 22, 0), (OP_MIN, 22, 1), (OP_AVERAGE, 22, 1)]:
+        yield from calculate(dut, start_address=0, element_count=4, result_address=4, op=op)
+        r = yield from recall_number(dut, location=4)
+        unsupported_op = yield dut.unsupported_op
+        if (r, unsupported_op) != (expected, unsupported):
+            raise Exception(f"op {op} is not calculated correctly. Got {r} and unsupported_op {unsupported_op} but was expecting {expected} and {unsupported}")
+    if hasattr(dut, "divider"):
+        raise Exception("divider is built without OP_AVERAGE")
+
+    print('Ops simulation ended successfully')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calculator simulation")
+    parser.add_argument("--fast", action="store_true", help="No VCD files and no per-transaction logging")
+    args = parser.parse_args()
+    verbose = not args.fast
+
+    def vcd_name(name):
+        return None if args.fast else name
+
+    dut = Calculator(16,5)
+    run_simulation(dut, simulation_story(dut), vcd_name=vcd_name("test_average_mem.vcd"))
+
+    dut = Calculator(16,5,divider="reciprocal")
+    run_simulation(dut, simulation_story(dut), vcd_name=vcd_name("test_average_mem_reciprocal.vcd"))
+
+    dut = Calculator(16,5,lanes=4)
+    run_simulation(dut, simulation_story(dut), vcd_name=vcd_name("test_average_mem_lanes.vcd"))
+
+    dut = Calculator(16,5,accumulator_width=16)
+    run_simulation(dut, overflow_story(dut), vcd_name=vcd_name("test_average_mem_overflow.vcd"))
+
+    for lanes in [1, 2, 4]:
+        dut = Calculator(16,8,lanes=lanes,accumulator_width=16)
+        run_simulation(dut, row_overflow_story(dut), vcd_name=vcd_name(f"test_average_mem_row_overflow_{lanes}.vcd"))
+
+    # with 8 lanes the storage is a single row
+    init = list(range(100, 108))
+    for lanes in [2, 8]:
+        dut = Calculator(16,8,lanes=lanes,init=init)
+        run_simulation(dut, bulk_story(dut, init), vcd_name=vcd_name(f"test_average_mem_bulk_{lanes}.vcd"))
+
+    dut = Calculator(16,5,dual_port=True)
+    run_simulation(dut, simulation_story(dut), vcd_name=vcd_name("test_average_mem_dual_port.vcd"))
+
+    dut = Calculator(16,8,lanes=2,dual_port=True)
+    run_simulation(dut, dual_port_story(dut), vcd_name=vcd_name("test_average_mem_dual_port_overlap.vcd"))
+
+    for dual_port in [False, True]:
+        dut = Calculator(16, 8, lanes=2, dual_port=dual_port)
+        run_simulation(dut, store_during_result_story(dut))
+        dut = Calculator(16, 8, lanes=2, dual_port=dual_port)
+        run_simulation(dut, recall_during_result_story(dut))
+
+    dut = Calculator(16,4,lanes=2,dual_port=True,double_buffer=True)
+    run_simulation(dut, double_buffer_story(dut), vcd_name=vcd_name("test_average_mem_double_buffer.vcd"))
+
+    dut = Calculator(16,5,lanes=2,ops=(OP_SUM, OP_MAX))
+    run_simulation(dut, ops_story(dut), vcd_name=vcd_name("test_average_mem_ops.vcd"))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+import numpy as np
+from migen import *
+
+import test_average_mem
+from calculator import *
+from test_average_mem import tick, dump_memory
+
+# Randomized differential test: many datasets are averaged by the calculator and by NumPy,
+# floor(sum/n) for each, and the two are compared in bulk. The datasets sit one after the
+# other in the storage, loaded through init=, and run as batches of queued jobs that write
+# their averages after the last dataset.
+
+def make_datasets(rng, datasets, max_size, width):
+    sizes = rng.integers(1, max_size + 1, size=datasets)
+    offsets = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    numbers = rng.integers(0, 2**width, size=int(sizes.sum()), dtype=np.uint64)
+    return numbers, offsets, sizes
+
+def golden_model(numbers, offsets, sizes):
+    return np.add.reduceat(numbers, offsets) // sizes.astype(np.uint64)
+
+def batch_story(dut, offsets, sizes, result_location, batch_size, cycles):
+    for first in range(0, len(sizes), batch_size):
+        for job in range(first, min(first + batch_size, len(sizes))):
+            yield dut.job_start_address.eq(int(offsets[job]))
+            yield dut.job_element_count.eq(int(sizes[job]))
+            yield dut.job_divide_by.eq(int(sizes[job]))
+            yield dut.job_result_address.eq(result_location + job)
+            yield dut.job_op.eq(OP_AVERAGE)
+            yield dut.job_push.eq(1)
+            yield from tick()
+        yield dut.job_push.eq(0)
+
+        yield dut.run_batch.eq(1)
+        yield from tick()
+        cycles[0] += 1
+        while not (yield dut.batch_done):
+            yield from tick()
+            cycles[0] += 1
+        yield dut.run_batch.eq(0)
+        yield from tick()
+
+def run_calculator(numbers, offsets, sizes, width, lanes, divider, batch_size):
+    result_location = len(numbers)
+    depth = result_location + len(sizes)
+    dut = Calculator(width, depth, divider=divider, lanes=lanes, job_queue_depth=batch_size, init=numbers)
+    cycles = [0]
+    results = []
+
+    def story():
+        yield from batch_story(dut, offsets, sizes, result_location, batch_size, cycles)
+        results.extend((yield from dump_memory(dut.banks, result_location, len(sizes))))
+
+    run_simulation(dut, story())
+    return np.array(results, dtype=np.uint64), cycles[0]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calculator against a NumPy golden model on random datasets")
+    parser.add_argument("--datasets", type=int, default=100,   help="Number of datasets")
+    parser.add_argument("--max-size", type=int, default=64,    help="Largest dataset")
+    parser.add_argument("--width",    type=int, default=32,    help="Data width")
+    parser.add_argument("--lanes",    type=int, default=4,     help="Calculator lanes")
+    parser.add_argument("--divider",  default="restoring",     help="Divider backend, restoring or reciprocal")
+    parser.add_argument("--batch",    type=int, default=16,    help="Jobs queued per batch")
+    parser.add_argument("--clock",    type=float, default=50e6, help="Calculator clock frequency in Hz")
+    parser.add_argument("--seed",     type=int, default=0,     help="Random seed")
+    args = parser.parse_args()
+    test_average_mem.verbose = False
+
+    rng = np.random.default_rng(args.seed)
+    numbers, offsets, sizes = make_datasets(rng, args.datasets, args.max_size, args.width)
+
+    start = time.perf_counter()
+    expected = golden_model(numbers, offsets, sizes)
+    numpy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results, cycles = run_calculator(numbers, offsets, sizes, args.width, args.lanes, args.divider, args.batch)
+    simulation_seconds = time.perf_counter() - start
+
+    mismatches = np.flatnonzero(results != expected)
+    for job in mismatches[:10]:
+        print(f"dataset {job} of {sizes[job]} numbers at {offsets[job]}: got {results[job]} but was expecting {expected[job]}")
+    if len(mismatches):
+        raise Exception(f"{len(mismatches)} of {len(sizes)} averages do not match the golden model")
+
+    elements = len(numbers)
+    calculator_seconds = cycles/args.clock
+    print(f"{len(sizes)} datasets, {elements} numbers")
+    print(f"NumPy:      {numpy_seconds*1e6:.1f} us, {elements/numpy_seconds:.3g} numbers/s")
+    print(f"Calculator: {cycles} cycles, {calculator_seconds*1e6:.1f} us at {args.clock/1e6:g} MHz, "
+          f"{elements/calculator_seconds:.3g} numbers/s, speedup {numpy_seconds/calculator_seconds:.2f}")
+    print(f"Simulation: {simulation_seconds:.1f} s")
+    print('Golden model simulation ended successfully')
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+from migen import *
+
+from verilator_sim import VerilatorModel, run_verilator
+
+# run_verilator against run_simulation without Verilator: the library of the model is a Python
+# fake of the harness, sim_get/sim_set a 32-bit word at a time and the clock edges, behaving
+# like the Verilated Accumulator below. The same story runs on both and sees the same values.
+
+class Accumulator(Module):
+    def __init__(self):
+        self.value = Signal(40)
+        self.enable = Signal()
+        self.total = Signal(48)
+        self.delta = Signal((41, True))
+
+        ###
+
+        self.sync += If(self.enable, self.total.eq(self.total + self.value))
+        self.comb += self.delta.eq(self.value - self.total)
+
+# what the harness does with a Verilated Accumulator, the ports are (value, enable, total, delta)
+class FakeAccumulatorLibrary:
+    WIDTHS = [40, 1, 48, 41]
+
+    def __init__(self):
+        self.values = [0, 0, 0, 0]
+        self.eval()
+
+    def sim_get(self, handle, port, word):
+        return (self.values[port] >> (32*word)) & 0xffffffff
+
+    def sim_set(self, handle, port, word, value):
+        mask = 0xffffffff << (32*word)
+        self.values[port] = (self.values[port] & ~mask | value << (32*word)) & (2**self.WIDTHS[port] - 1)
+
+    def sim_eval(self, handle):
+        self.eval()
+
+    def sim_rising_edge(self, handle):
+        value, enable, total, delta = self.values
+        if enable:
+            self.values[2] = (total + value) & (2**48 - 1)
+        self.eval()
+
+    def sim_falling_edge(self, handle):
+        self.eval()
+
+    def eval(self):
+        self.values[3] = (self.values[0] - self.values[2]) & (2**41 - 1)
+
+def fake_model(dut):
+    # a VerilatorModel without building anything, read() and write() are the real ones
+    model = VerilatorModel.__new__(VerilatorModel)
+    ports = [dut.value, dut.enable, dut.total, dut.delta]
+    model.ports = {signal: (index, signal.backtrace[-1][0]) for index, signal in enumerate(ports)}
+    model.lib = FakeAccumulatorLibrary()
+    model.handle = None
+    model.cycles = 0
+    return model
+
+@passive
+def enable_monitor(dut, enabled):
+    while True:
+        enabled.append((yield dut.enable))
+        yield
+
+def accumulator_story(dut, seen):
+    # words wider than 32 bits and a signed port, written and read around the clock edges
+    for value, enable in [(5, 1), (2**33 + 7, 1), (3, 0), (2**39 - 1, 1), (1, 1), (0, 0)]:
+        yield dut.value.eq(value)
+        yield dut.enable.eq(enable)
+        seen.append(((yield dut.total), (yield dut.delta)))
+        yield
+        seen.append(((yield dut.total), (yield dut.delta)))
+    yield
+
+if __name__ == "__main__":
+    seen = {}
+    enabled = {}
+    for runner in ["run_simulation", "run_verilator"]:
+        seen[runner] = []
+        enabled[runner] = []
+        dut = Accumulator()
+        generators = [accumulator_story(dut, seen[runner]), enable_monitor(dut, enabled[runner])]
+        if runner == "run_simulation":
+            run_simulation(dut, generators)
+        else:
+            model = fake_model(dut)
+            run_verilator(model, generators)
+            # the 7 cycles of the story and the one it ends in
+            if model.cycles != 8:
+                raise Exception(f"run_verilator ran {model.cycles} cycles but was expecting 8")
+
+    if seen["run_verilator"] != seen["run_simulation"]:
+        raise Exception(f"run_verilator saw {seen['run_verilator']} but run_simulation saw {seen['run_simulation']}")
+    if enabled["run_verilator"] != enabled["run_simulation"]:
+        raise Exception(f"passive generator saw {enabled['run_verilator']} under run_verilator but "
+                        f"{enabled['run_simulation']} under run_simulation")
+    if seen["run_simulation"][-1] != (2**39 + 2**33 + 12, -(2**39 + 2**33 + 12)):
+        raise Exception(f"accumulator story ended with {seen['run_simulation'][-1]}")
+
+    print('Verilator runner simulation ended successfully')
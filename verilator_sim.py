@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+import argparse
+import ctypes
+import os
+import random
+import shutil
+import subprocess
+import time
+
+from migen import *
+from migen.fhdl import verilog
+from migen.fhdl.structure import _Statement
+from migen.sim.core import Evaluator
+
+# Runs simulation_story style generators on a Verilator model of the design instead of
+# migen's Python simulator. The design is converted to Verilog, compiled with a small C++
+# harness into a shared library and driven through ctypes. The generators yield the same
+# things as under run_simulation: None for a clock cycle, a statement to write and an
+# expression to read, but only the signals given as ios can be read or written.
+
+# a 32-bit word at a time, wider ports are split in words
+HARNESS = """\
+#include <cstdint>
+#include "verilated.h"
+#include "V{name}.h"
+
+double sc_time_stamp() {{ return 0; }}
+
+extern "C" {{
+
+void *sim_create() {{
+    V{name} *top = new V{name};
+    top->sys_clk = 0;
+    top->sys_rst = 0;
+    top->eval();
+    return top;
+}}
+
+void sim_destroy(void *handle) {{
+    delete (V{name} *)handle;
+}}
+
+uint32_t sim_get(void *handle, int port, int word) {{
+    V{name} *top = (V{name} *)handle;
+    switch (port) {{
+{gets}
+    }}
+    return 0;
+}}
+
+void sim_set(void *handle, int port, int word, uint32_t value) {{
+    V{name} *top = (V{name} *)handle;
+    switch (port) {{
+{sets}
+    }}
+}}
+
+void sim_eval(void *handle) {{
+    ((V{name} *)handle)->eval();
+}}
+
+// rising edge only, the inputs written by the generators are applied after it
+void sim_rising_edge(void *handle) {{
+    V{name} *top = (V{name} *)handle;
+    top->sys_clk = 1;
+    top->eval();
+}}
+
+void sim_falling_edge(void *handle) {{
+    V{name} *top = (V{name} *)handle;
+    top->sys_clk = 0;
+    top->eval();
+}}
+
+}}
+"""
+
+def default_ios(dut):
+    # every public Signal of the module
+    ios = []
+    for attribute, value in vars(dut).items():
+        if isinstance(value, Signal) and not attribute.startswith("_") and value not in ios:
+            ios.append(value)
+    return ios
+
+def port_accessors(index, name, nbits):
+    if nbits <= 32:
+        get = f"        case {index}: return top->{name};"
+        set = f"        case {index}: top->{name} = value; break;"
+    elif nbits <= 64:
+        get = f"        case {index}: return top->{name} >> (32*word);"
+        set = (f"        case {index}: top->{name} = (top->{name} & ~((QData)0xffffffff << (32*word)))"
+               f" | ((QData)value << (32*word)); break;")
+    else:
+        get = f"        case {index}: return top->{name}[word];"
+        set = f"        case {index}: top->{name}[word] = value; break;"
+    return get, set
+
+class VerilatorModel:
+    def __init__(self, dut, ios=None, name="top", build_dir=None, verbose=False):
+        if shutil.which("verilator") is None:
+            raise RuntimeError("verilator not found in PATH, install it or use run_simulation")
+        if ios is None:
+            ios = default_ios(dut)
+        if build_dir is None:
+            build_dir = os.path.join("build", "verilator", name)
+        self.build_dir = os.path.abspath(build_dir)
+        os.makedirs(self.build_dir, exist_ok=True)
+
+        # the model is only rebuilt when the Verilog changes
+        conversion = verilog.convert(dut, ios=set(ios), name=name)
+        self.ports = {signal: (index, conversion.ns.get_name(signal)) for index, signal in enumerate(ios)}
+        source = os.path.join(self.build_dir, name + ".v")
+        library = os.path.join(self.build_dir, "lib" + name + ".so")
+        previous = open(source).read() if os.path.exists(source) else None
+        if previous != str(conversion) or not os.path.exists(library):
+            conversion.write(source)
+            self.compile(name, source, library, verbose)
+
+        self.lib = ctypes.CDLL(library)
+        self.lib.sim_create.restype = ctypes.c_void_p
+        self.lib.sim_destroy.argtypes = [ctypes.c_void_p]
+        self.lib.sim_get.restype = ctypes.c_uint32
+        self.lib.sim_get.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
+        self.lib.sim_set.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_uint32]
+        self.lib.sim_eval.argtypes = [ctypes.c_void_p]
+        self.lib.sim_rising_edge.argtypes = [ctypes.c_void_p]
+        self.lib.sim_falling_edge.argtypes = [ctypes.c_void_p]
+
+        # memory init files are read relative to the working directory on the first eval
+        cwd = os.getcwd()
+        os.chdir(self.build_dir)
+        try:
+            self.handle = self.lib.sim_create()
+        finally:
+            os.chdir(cwd)
+        self.cycles = 0
+
+    def compile(self, name, source, library, verbose):
+        gets, sets = [], []
+        for signal, (index, port) in self.ports.items():
+            get, set = port_accessors(index, port, len(signal))
+            gets.append(get)
+            sets.append(set)
+        harness = os.path.join(self.build_dir, name + "_harness.cpp")
+        with open(harness, "w") as f:
+            f.write(HARNESS.format(name=name, gets="\n".join(gets), sets="\n".join(sets)))
+        command = ["verilator", "--cc", "--exe", "--build", "-O3", "-Wno-fatal",
+                   "--top-module", name, "--Mdir", os.path.join(self.build_dir, "obj"),
+                   "-CFLAGS", "-fPIC -O2", "-LDFLAGS", "-shared", "-o", library,
+                   source, harness]
+        subprocess.run(command, check=True, cwd=self.build_dir,
+                       stdout=None if verbose else subprocess.DEVNULL)
+
+    def read(self, signal):
+        index, port = self.ports[signal]
+        value = 0
+        for word in range((len(signal) + 31)//32):
+            value |= self.lib.sim_get(self.handle, index, word) << (32*word)
+        value &= 2**len(signal) - 1
+        if signal.signed and value >> (len(signal) - 1):
+            value -= 2**len(signal)
+        return value
+
+    def write(self, signal, value):
+        index, port = self.ports[signal]
+        value &= 2**len(signal) - 1
+        for word in range((len(signal) + 31)//32):
+            self.lib.sim_set(self.handle, index, word, (value >> (32*word)) & 0xffffffff)
+
+    def close(self):
+        if self.handle is not None:
+            self.lib.sim_destroy(self.handle)
+            self.handle = None
+
+# reads the ports from the model, everything else is evaluated like migen does
+class ModelEvaluator(Evaluator):
+    def __init__(self, model):
+        Evaluator.__init__(self, {}, {})
+        self.model = model
+
+    def eval(self, node, postcommit=False):
+        if isinstance(node, Signal):
+            if postcommit and node in self.modifications:
+                return self.modifications[node]
+            if node not in self.model.ports:
+                raise KeyError(f"{node} is not a port of the Verilator model")
+            return self.model.read(node)
+        return Evaluator.eval(self, node, postcommit)
+
+    def commit(self):
+        for signal, value in self.modifications.items():
+            if signal not in self.model.ports:
+                raise KeyError(f"{signal} is not a port of the Verilator model")
+            self.model.write(signal, value)
+        self.modifications.clear()
+
+# Same cycle semantics as run_simulation: the generators see the values before the clock
+# edge and what they write takes effect together with the edge. Passive generators do not
+# keep the simulation running.
+def run_verilator(model, generators):
+    if not isinstance(generators, list):
+        generators = [generators]
+    evaluator = ModelEvaluator(model)
+    running = list(generators)
+    passive_generators = set()
+    while set(running) - passive_generators:
+        for generator in list(running):
+            reply = None
+            while True:
+                try:
+                    request = generator.send(reply)
+                except StopIteration:
+                    running.remove(generator)
+                    break
+                if request is None:
+                    break
+                elif isinstance(request, str):
+                    if request == "passive":
+                        passive_generators.add(generator)
+                    elif request == "active":
+                        passive_generators.discard(generator)
+                    else:
+                        raise ValueError(f"Unknown simulator command: '{request}'")
+                    reply = None
+                elif isinstance(request, _Statement):
+                    evaluator.execute([request])
+                    reply = None
+                else:
+                    reply = evaluator.eval(request)
+        model.lib.sim_rising_edge(model.handle)
+        evaluator.commit()
+        model.lib.sim_eval(model.handle)
+        model.lib.sim_falling_edge(model.handle)
+        model.cycles += 1
+
+def average_story(dut, numbers, divide_by):
+    # load through the store handshake, then average everything into location 0
+    for location, number in enumerate(numbers):
+        yield dut.where_to_store_or_recall.eq(location)
+        yield dut.number_to_store.eq(number)
+        yield dut.store_now_active.eq(1)
+        yield
+        while not (yield dut.stored):
+            yield
+        yield dut.store_now_active.eq(0)
+        yield
+        yield
+
+    yield dut.start_address.eq(0)
+    yield dut.element_count.eq(len(numbers))
+    yield dut.result_address.eq(0)
+    yield dut.divide_by.eq(divide_by)
+    yield dut.calculate_now_active.eq(1)
+    while not (yield dut.calculated):
+        yield
+    result = yield dut.result
+    yield dut.calculate_now_active.eq(0)
+    yield
+
+    expected = min(sum(numbers), 2**len(dut.summed_number) - 1)//divide_by
+    if result != expected:
+        raise Exception(f"average is not calculated correctly. Got {result} but was expecting {expected}")
+    print(f"Average of {len(numbers)} numbers is {result}")
+
+if __name__ == "__main__":
+    import test_average_mem
+    import memory_storage
+    from calculator import Calculator
+    from memory_storage import Mem
+
+    parser = argparse.ArgumentParser(description="Simulation stories on a Verilator model")
+    parser.add_argument("--depth", type=int, default=65536, help="Calculator depth for the large average")
+    parser.add_argument("--seed",  type=int, default=0,     help="Random seed")
+    args = parser.parse_args()
+    test_average_mem.verbose = False
+    memory_storage.verbose = False
+
+    dut = Calculator(16,5)
+    model = VerilatorModel(dut, name="calculator")
+    run_verilator(model, test_average_mem.simulation_story(dut))
+
+    dut = Mem(16, 128)
+    model = VerilatorModel(dut, name="mem")
+    run_verilator(model, memory_storage.simulation_story(dut, padding=0))
+
+    random.seed(args.seed)
+    dut = Calculator(32, args.depth)
+    model = VerilatorModel(dut, name="calculator_large")
+    numbers = [random.randrange(2**32) for location in range(args.depth)]
+    start = time.perf_counter()
+    run_verilator(model, average_story(dut, numbers, divide_by=len(numbers)))
+    elapsed = time.perf_counter() - start
+    print(f"{model.cycles} cycles in {elapsed:.1f} s, {model.cycles/elapsed:.0f} cycles per second")